@@ -0,0 +1,62 @@
+import threading
+
+from metrics import IN_FLIGHT, REJECTED
+
+# total clients/profiles that heavy requests may have in flight at once
+MAX_HEAVY_COST = 10000
+# seconds a rejected client is asked to wait before trying again
+RETRY_AFTER = 1
+
+
+class AdmissionControl:
+    """ Bounds the requests in flight and turns the rest away at once.
+
+    A request with a cost (clients or profiles it asks for) is heavy: heavy requests may not take the
+    last `reserved` slots and their total cost is bounded, so single scores keep getting through
+    when heavy ones pile up. A heavy request is let in when no other one is running, whatever its cost.
+    By default a quarter of the slots is reserved, at least one but never all of them.
+    """
+
+    def __init__(self, max_in_flight, reserved=None, max_heavy_cost=MAX_HEAVY_COST):
+        self.max_in_flight = max_in_flight
+        # with a single slot nothing is reserved, or heavy requests could never get in
+        self.reserved = min(max(1, max_in_flight // 4), max_in_flight - 1) if reserved is None else reserved
+        self.max_heavy_cost = max_heavy_cost
+        self.in_flight = 0
+        self.heavy_cost = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, cost=0):
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                reason = "in_flight"
+            elif cost and self.in_flight >= self.max_in_flight - self.reserved:
+                reason = "heavy_in_flight"
+            elif cost and self.heavy_cost and self.heavy_cost + cost > self.max_heavy_cost:
+                reason = "heavy_cost"
+            else:
+                self.in_flight += 1
+                self.heavy_cost += cost
+                self.admitted += 1
+                IN_FLIGHT.set(self.in_flight)
+                return True
+            self.rejected += 1
+        REJECTED.inc(reason=reason)
+        return False
+
+    def release(self, cost=0):
+        with self._lock:
+            self.in_flight -= 1
+            self.heavy_cost -= cost
+            IN_FLIGHT.set(self.in_flight)
+
+    def stats(self):
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "heavy_cost": self.heavy_cost,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
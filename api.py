@@ -2,16 +2,29 @@
 # -*- coding: utf-8 -*-
 
 from abc import ABC
-import json
 import datetime
+import functools
 import logging
 import hashlib
+import hmac
+import time
 import uuid
+import os
+import signal
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from optparse import OptionParser
 import re
-from scoring import get_score, get_interests
+import scoring
+from scoring import get_score, get_scores, get_interests_bulk
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from store import Store
+from store import Store, add_store_options, store_config_from_options
+from cache import TTLCache
+import codec
+import logs
+from admission import AdmissionControl, MAX_HEAVY_COST, RETRY_AFTER
+from metrics import REGISTRY, REQUEST_SECONDS, STAGE_SECONDS, STORE_STATS, REJECTED, CONTENT_TYPE, timed
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -22,12 +35,14 @@ FORBIDDEN = 403
 NOT_FOUND = 404
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
 }
 UNKNOWN = 0
 MALE = 1
@@ -38,6 +53,30 @@ GENDERS = {
     FEMALE: "female",
 }
 AGE_LIMIT = 70
+# profiles accepted by a single online_score_batch request
+BATCH_LIMIT = 1000
+# (account, login) pairs whose expected tokens are kept precomputed
+AUTH_CACHE_SIZE = 10000
+# distinct date strings whose parsed value is kept
+DATE_CACHE_SIZE = 4096
+# clients_interests answers for more clients than this are streamed, STREAM_CHUNK clients per storage round trip
+STREAM_THRESHOLD = 1000
+STREAM_CHUNK = 1000
+PHONE_PATTERN = re.compile(r'^7\d{10}')
+DEFAULT_THREADS = 16
+# listen() backlog, and accepted connections allowed to wait for a free thread before new ones get a 503
+BACKLOG = 128
+MAX_PENDING = 64
+# persistent connections: idle seconds before closing and requests served per connection
+KEEPALIVE_TIMEOUT = 5
+KEEPALIVE_MAX_REQUESTS = 100
+
+
+_user_digests = TTLCache(maxsize=AUTH_CACHE_SIZE)
+# (valid until, digest) of the admin token for the current hour
+_admin_digest = (0, None)
+# (valid until, earliest birthday) for today
+_age_limit_cutoff = (0, None)
 
 
 class ValidationError(Exception):
@@ -46,10 +85,6 @@ class ValidationError(Exception):
         self.message = message
 
 
-class DataNotProvided(Exception):
-    """Handling 'None' assignment"""
-
-
 class BaseField(ABC):
     def __init__(self, required=False, nullable=True):
         self.required = required
@@ -57,33 +92,32 @@ class BaseField(ABC):
 
     def __set_name__(self, owner, name):
         self._name = name
+        # the value lives in this attribute, which is a slot on request objects
+        self._attr = "_" + name
 
     def __get__(self, instance, owner):
-        return instance.__dict__[self._name]
+        if instance is None:
+            return self
+        return getattr(instance, self._attr)
 
     def __set__(self, instance, value):
-        try:
-            self.validate_field(instance, value)
-        except DataNotProvided:
-            instance.__dict__[self._name] = None
-        except:
-            logging.exception("Validation error")
-            raise
+        if value is None:
+            self.check_null()
+            setattr(instance, self._attr, None)
         else:
-            value = self.value_conversion(value)
-            instance.__dict__[self._name] = value
+            setattr(instance, self._attr, self.clean(value))
 
-    def validate_field(self, instance, value):
-        if value is None:
-            if self.required is True:
-                raise ValidationError(message="The parameter '%s' is mandatory" % self._name)
+    def clean(self, value):
+        """ Validates a non-null value and returns it converted, in one pass """
+        self.check_conditions(value)
+        return self.value_conversion(value)
 
-            if self.nullable is False:
-                raise ValidationError(message="The parameter '%s' should be non-nullable" % self._name)
+    def check_null(self):
+        if self.required is True:
+            raise ValidationError(message="The parameter '%s' is mandatory" % self._name)
 
-            raise DataNotProvided
-        else:
-            self.check_conditions(value)
+        if self.nullable is False:
+            raise ValidationError(message="The parameter '%s' should be non-nullable" % self._name)
 
     def check_conditions(self, value):
         """Specific conditions for each field"""
@@ -118,37 +152,51 @@ class PhoneField(BaseField):
         if not isinstance(value, (int, str)):
             raise ValidationError(message="The parameter %s should be a string or integer" % self.__class__)
 
-        phone_pattern = re.compile(r'^7\d{10}')
-        if not phone_pattern.match('%s' % value):
+        if not PHONE_PATTERN.match('%s' % value):
             raise ValidationError(message="Invalid phone number given: %s" % value)
 
     def value_conversion(self, value):
         return str(value)
 
 
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(value):
+    return datetime.date(year=int(value[6:]),
+                         month=int(value[3:5]),
+                         day=int(value[:2]))
+
+
+def age_limit_cutoff():
+    """ Earliest birthday within AGE_LIMIT, worked out once a day """
+    global _age_limit_cutoff
+    valid_until, cutoff = _age_limit_cutoff
+    if time.time() >= valid_until:
+        now = datetime.datetime.now()
+        tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+        cutoff = now.date() - datetime.timedelta(days=int(AGE_LIMIT * 365.2425))
+        _age_limit_cutoff = (time.time() + (tomorrow - now).total_seconds(), cutoff)
+    return cutoff
+
+
 class DateField(CharField):
     def check_conditions(self, value):
+        self.clean(value)
+
+    def clean(self, value):
         super().check_conditions(value)
         try:
-            self.value_conversion(value)
-        except:
+            return parse_date(value)
+        except (TypeError, ValueError):
             raise ValidationError(message="Invalid date; date should have a format 'DD.MM.YYYY' but %s is given"
                                   % value)
 
-    def value_conversion(self, value):
-        return datetime.date(year=int(value[6:]),
-                             month=int(value[3:5]),
-                             day=int(value[:2]))
-
 
 class BirthDayField(DateField):
-    def check_conditions(self, value):
-        super().check_conditions(value)
-
-        birthday = self.value_conversion(value)
-
-        if datetime.date.today() - birthday > datetime.timedelta(AGE_LIMIT * 365.2425):
+    def clean(self, value):
+        birthday = super().clean(value)
+        if birthday < age_limit_cutoff():
             raise ValidationError(message="Age limit exceeded")
+        return birthday
 
 
 class GenderField(BaseField):
@@ -176,17 +224,46 @@ class ClientIDsField(BaseField):
                 raise ValidationError(message="Invalid client ID is given: %s" % value)
 
 
-class ApiRequest:
+class BatchArgumentsField(BaseField):
+    def check_conditions(self, value):
+        if not isinstance(value, list):
+            raise ValidationError(message="The parameter %s should be a list" % self.__class__)
+
+        if not value:
+            raise ValidationError(message="Batch is empty")
+
+        if len(value) > BATCH_LIMIT:
+            raise ValidationError(message="Batch is too large: %s items, %s allowed" % (len(value), BATCH_LIMIT))
+
+        for item in value:
+            if not isinstance(item, dict):
+                raise ValidationError(message="Invalid batch item is given: %s" % item)
+
+
+class RequestMeta(type):
+    """Collects the fields of a request class once, when the class is created,
+    and stores their values in __slots__ instead of a per-instance __dict__"""
+    def __new__(mcs, name, bases, namespace):
+        fields = tuple((k, v) for k, v in namespace.items() if isinstance(v, BaseField))
+        namespace.setdefault("__slots__", tuple("_" + k for k, _ in fields))
+        cls = super().__new__(mcs, name, bases, namespace)
+        cls.fields = fields
+        cls.valid_fields = tuple(k for k, _ in fields)
+        return cls
+
+
+class ApiRequest(metaclass=RequestMeta):
+    __slots__ = ("has",)
+
     def __init__(self, **kwargs):
-        self.valid_fields = [k for k, v in self.__class__.__dict__.items() if isinstance(v, BaseField)]
         self.has = []
 
-        for k in self.valid_fields:
-            if k in kwargs.keys():
-                setattr(self, k, kwargs[k])
+        for k, field in self.fields:
+            if k in kwargs:
+                field.__set__(self, kwargs[k])
                 self.has.append(k)
             else:
-                setattr(self, k, None)
+                field.__set__(self, None)
 
         self.validate()
 
@@ -224,45 +301,74 @@ class OnlineScoreRequest(MethodRequest):
             raise ValidationError(message="Not enough data provided")
 
 
+class OnlineScoreBatchRequest(MethodRequest):
+    items = BatchArgumentsField(required=True, nullable=False)
+
+
+def user_digest(account, login):
+    key = (account, login)
+    digest = _user_digests.get(key)
+    if digest is None:
+        phrase = account + login + SALT
+        digest = hashlib.sha512(phrase.encode('utf-8')).hexdigest().encode('ascii')
+        _user_digests.set(key, digest)
+    return digest
+
+
+def admin_digest():
+    global _admin_digest
+    valid_until, digest = _admin_digest
+    if time.time() >= valid_until:
+        # the admin token changes with the local hour, compute it once per hour
+        now = datetime.datetime.now()
+        next_hour = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+        phrase = now.strftime("%Y%m%d%H") + ADMIN_SALT
+        digest = hashlib.sha512(phrase.encode('utf-8')).hexdigest().encode('ascii')
+        _admin_digest = (time.time() + (next_hour - now).total_seconds(), digest)
+    return digest
+
+
 def check_auth(request):
     if request.is_admin:
-        phrase = datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT
-        digest = hashlib.sha512(phrase.encode('utf-8')).hexdigest()
+        digest = admin_digest()
     else:
-        phrase = request.account + request.login + SALT
-        digest = hashlib.sha512(phrase.encode('utf-8')).hexdigest()
-    logging.info('TOKEN: %s' % digest)
-    if digest == request.token:
-        return True
-    return False
+        digest = user_digest(request.account, request.login)
+    token = (request.token or "").encode('utf-8')
+    return hmac.compare_digest(digest, token)
 
 
 def method_handler(request, ctx, store):
     response, code, ctx = None, None, ctx
     methods = {
         'online_score': online_score_handler,
+        'online_score_batch': online_score_batch_handler,
         'clients_interests': clients_interests_handler
     }
-    _request = request
     try:
-        request = MethodRequest(**request.get("body"))
-
-        if not check_auth(request):
+        with timed(ctx, "validation"):
+            request = MethodRequest(**request.get("body"))
+        if request.method in methods:
+            ctx["method"] = request.method
+
+        with timed(ctx, "auth"):
+            authorized = check_auth(request)
+        if not authorized:
             logging.error("Wrong authentication token")
             return None, FORBIDDEN, ctx
 
         try:
-            response, code, ctx = methods[request.method](request, ctx, store)
+            with timed(ctx, "handler"):
+                response, code, ctx = methods[request.method](request, ctx, store)
         except ValidationError:
             raise
         except:
-            logging.exception("Error during request: %s" % _request)
+            logging.exception("Error during %s request %s", request.method, ctx.get("request_id"))
             raise
         else:
             return response, code, ctx
 
     except ValidationError as e:
-        logging.error("Validation error: %s" % e.message)
+        logging.error("Validation error: %s", e.message)
         code = INVALID_REQUEST
         return {'msg': 'validation error'}, code, ctx
     except Exception as e:
@@ -283,72 +389,444 @@ def online_score_handler(request: MethodRequest, ctx, store):
     return response, OK, ctx
 
 
+def online_score_batch_handler(request: MethodRequest, ctx, store):
+    batch = OnlineScoreBatchRequest(**request.arguments)
+    if request.is_admin:
+        return {"scores": [{"score": 42} for _ in batch.items]}, OK, ctx
+
+    results = score_items(store, batch.items)
+    ctx.update({"nitems": len(results), "nerrors": sum(1 for result in results if "error" in result)})
+    return {"scores": results}, OK, ctx
+
+
+def score_items(store, items):
+    """ {"score": ...} or {"error": ..., "code": ...} for every dict of online_score arguments;
+    invalid items get their own error, the rest is scored together """
+    results, valid, profiles = [], [], []
+    for i, arguments in enumerate(items):
+        try:
+            if not isinstance(arguments, dict):
+                raise ValidationError(message="Item should be an object")
+            item = OnlineScoreRequest(**arguments)
+        except ValidationError as e:
+            results.append({"error": e.message, "code": INVALID_REQUEST})
+            continue
+        results.append(None)
+        valid.append(i)
+        profiles.append({"phone": item.phone, "email": item.email, "birthday": item.birthday,
+                         "gender": item.gender, "first_name": item.first_name, "last_name": item.last_name})
+
+    for i, score in zip(valid, get_scores(store, profiles)):
+        results[i] = {"score": score}
+    return results
+
+
+class InterestsStream:
+    """ clients_interests response written piece by piece, one storage round trip per chunk of clients """
+
+    def __init__(self, store, cids, chunk_size=STREAM_CHUNK):
+        self.store = store
+        # same keys, in the same order, as a dict built from the list would have
+        self.cids = list(dict.fromkeys(cids))
+        self.chunk_size = chunk_size
+        # the first chunk is read up front, so a storage failure still gets a regular error response
+        self.first = get_interests_bulk(store, self.cids[:chunk_size])
+
+    def __len__(self):
+        return len(self.cids)
+
+    def parts(self):
+        interests = self.first
+        for i in range(0, len(self.cids), self.chunk_size):
+            cids = self.cids[i:i + self.chunk_size]
+            if i:
+                interests = get_interests_bulk(self.store, cids)
+            # members of the response object without the braces
+            yield codec.dumps({str(cid): interests[cid] for cid in cids})[1:-1]
+
+    def chunks(self, code):
+        """ Pieces of the same document build_response would give """
+        parts = self.parts()
+        yield b'{"response":{' + next(parts)
+        for part in parts:
+            yield b"," + part
+        yield b'},"code":%d}' % code
+
+
 def clients_interests_handler(request: MethodRequest, ctx, store):
     request = ClientsInterestsRequest(**request.arguments)
-    response = {}
-    for cid in request.client_ids:
-        interests = get_interests(store, cid)
-        response.update({str(cid): interests})
+    if len(request.client_ids) > STREAM_THRESHOLD:
+        response = InterestsStream(store, request.client_ids, STREAM_CHUNK)
+    else:
+        interests = get_interests_bulk(store, request.client_ids)
+        response = {str(cid): interests[cid] for cid in request.client_ids}
     ctx.update({"nclients": len(response)})
     return response, OK, ctx
 
 
+def request_cost(body):
+    """ Clients or profiles a /method request asks for, 0 for a single score """
+    arguments = body.get("arguments") if isinstance(body, dict) else None
+    if not isinstance(arguments, dict):
+        return 0
+    items = arguments.get({"clients_interests": "client_ids", "online_score_batch": "items"}.get(body.get("method")))
+    return len(items) if isinstance(items, list) else 0
+
+
+def build_response(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+def metrics_handler(store):
+    for name, value in store.cache_stats().items():
+        STORE_STATS.set(value, stat="cache_%s" % name)
+    for name, value in store.negative_cache_stats().items():
+        STORE_STATS.set(value, stat="negative_cache_%s" % name)
+    for name, value in store.write_behind_stats().items():
+        STORE_STATS.set(value, stat="write_behind_%s" % name)
+    for name, value in store.pool_stats().items():
+        STORE_STATS.set(value, stat="pool_%s" % name)
+    breaker = store.breaker_stats()
+    STORE_STATS.set(int(breaker["state"] == "open"), stat="breaker_open")
+    STORE_STATS.set(breaker["rejected"], stat="breaker_rejected")
+    for name, value in scoring.score_flight.stats().items():
+        STORE_STATS.set(value, stat="score_flight_%s" % name)
+    return REGISTRY.render(), CONTENT_TYPE
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler
     }
+    get_router = {
+        "metrics": metrics_handler
+    }
     store = Store()
+    # AdmissionControl bounding the requests in flight, None lets everything in
+    admission = None
+    protocol_version = "HTTP/1.1"
+    # idle timeout of a persistent connection, also bounds a stalled read or write
+    timeout = KEEPALIVE_TIMEOUT
+    max_requests = KEEPALIVE_MAX_REQUESTS
+    # responses are small, don't let Nagle hold them back on a reused connection
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+
+    def log_request(self, code="-", size="-"):
+        # every request gets one structured line from logs.log_request instead
+        pass
+
+    def log_message(self, format, *args):
+        logging.warning("%s " + format, self.address_string(), *args)
+
+    def handle_one_request(self):
+        # left as None when the connection times out waiting for its next request
+        self.raw_requestline = None
+        super().handle_one_request()
+
+    def log_error(self, format, *args):
+        if self.raw_requestline is None and format.startswith("Request timed out"):
+            # an idle keep-alive connection running out its timeout is closed quietly
+            return
+        self.log_message(format, *args)
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    def do_GET(self):
+        path = self.path.strip("/")
+        if path not in self.get_router:
+            self.write_response(NOT_FOUND, None, {"request_id": self.get_request_id(self.headers)})
+            return
+        body, content_type = self.get_router[path](self.store)
+        body = body.encode('utf-8')
+        self.send_response(OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_POST(self):
+        started = time.perf_counter()
+        self.requests_served += 1
+        if self.requests_served >= self.max_requests:
+            self.close_connection = True
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
         request = None
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
-        except:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            # without a valid length the next request on this connection can't be found
+            self.close_connection = True
             code = BAD_REQUEST
-
+        else:
+            try:
+                with timed(context, "read"):
+                    data_string = self.rfile.read(length)
+                with timed(context, "decode"):
+                    request = codec.loads(data_string)
+            except:
+                code = BAD_REQUEST
+
+        # cost held in admission control until the response is written
+        admitted = None
         if request or (request == {}):
             path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
+            logs.log_body(self.path, request, context["request_id"])
             if path in self.router:
-                try:
-                    response, code, context = self.router[path]({"body": request, "headers": self.headers},
-                                                                context, self.store)
-                except Exception as e:
-                    logging.exception("Unexpected error: %s" % e)
-                    code = INTERNAL_ERROR
+                cost = request_cost(request)
+                if self.admission is not None and not self.admission.acquire(cost):
+                    code = SERVICE_UNAVAILABLE
+                else:
+                    if self.admission is not None:
+                        admitted = cost
+                    try:
+                        response, code, context = self.router[path]({"body": request, "headers": self.headers},
+                                                                    context, self.store)
+                    except Exception as e:
+                        logging.exception("Unexpected error: %s", e)
+                        code = INTERNAL_ERROR
             else:
                 code = NOT_FOUND
+        try:
+            with timed(context, "write"):
+                self.write_response(code, response, context)
+        finally:
+            # a streamed response reads the storage while it is written, so the slot is held until the end
+            if admitted is not None:
+                self.admission.release(admitted)
+        self.observe(code, context, time.perf_counter() - started)
+        logs.log_request(context)
+
+    def write_response(self, code, response, context):
+        if isinstance(response, InterestsStream):
+            return self.write_stream(code, response, context)
+        r = build_response(response, code)
+        context.update(r)
+        result_string = codec.dumps(r)
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(result_string)))
+        if code == SERVICE_UNAVAILABLE:
+            self.send_header("Retry-After", str(RETRY_AFTER))
+        self.send_connection_header()
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        result_string = json.dumps(r).encode('utf-8')
         self.wfile.write(result_string)
-        return
 
+    def write_stream(self, code, stream, context):
+        context["code"] = code
+        # HTTP/1.0 clients know no chunked encoding, the end of their response is the end of the connection
+        chunked = self.request_version == "HTTP/1.1"
+        if not chunked:
+            self.close_connection = True
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.send_connection_header()
+        self.end_headers()
+        try:
+            for chunk in stream.chunks(code):
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except Exception as e:
+            # the status is sent already: cut the response short so that the client sees it is incomplete
+            logging.exception("Cannot stream the response: %s", e)
+            self.close_connection = True
+
+    def send_connection_header(self):
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        else:
+            self.send_header("Keep-Alive", "timeout=%s, max=%s" % (self.timeout, self.max_requests))
+
+    def observe(self, code, context, duration):
+        method = context.get("method", "unknown")
+        REQUEST_SECONDS.observe(duration, method=method, code=code)
+        for stage, seconds in context.get("timings", {}).items():
+            STAGE_SECONDS.observe(seconds, stage=stage, method=method)
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTPServer that handles connections on a bounded pool of threads"""
+
+    def __init__(self, server_address, handler_class, threads=DEFAULT_THREADS, reuse_port=False, backlog=BACKLOG,
+                 max_pending=None):
+        self.reuse_port = reuse_port
+        self.request_queue_size = backlog
+        self.threads = threads
+        self.max_pending = max_pending
+        # accepted and not yet closed: the ones beyond the number of threads wait in the executor queue
+        self.connections = 0
+        self._connections_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="handler")
+        super().__init__(server_address, handler_class)
+
+    def server_bind(self):
+        if self.reuse_port:
+            # several worker processes listen on the same port, the kernel balances connections between them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            overloaded = self.max_pending is not None and self.connections >= self.threads + self.max_pending
+            if not overloaded:
+                self.connections += 1
+        if overloaded:
+            self.reject(request)
+            return
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def reject(self, request):
+        """ Answers 503 right from the accepting thread instead of queueing the connection """
+        REJECTED.inc(reason="pending")
+        body = codec.dumps(build_response(None, SERVICE_UNAVAILABLE))
+        head = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nRetry-After: %d\r\n" \
+               "Connection: close\r\n\r\n" % (SERVICE_UNAVAILABLE, ERRORS[SERVICE_UNAVAILABLE], len(body), RETRY_AFTER)
+        try:
+            request.setblocking(False)
+            # read what the client has sent already, closing a socket with unread data resets the connection
+            request.recv(65536)
+        except OSError:
+            pass
+        try:
+            request.send(head.encode("latin-1") + body)
+        except OSError:
+            pass
+        self.shutdown_request(request)
 
-if __name__ == "__main__":
-    op = OptionParser()
-    op.add_option("-p", "--port", action="store", type=int, default=8089)
-    op.add_option("-l", "--log", action="store", default=None)
-    (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._connections_lock:
+                self.connections -= 1
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def serve(port, threads=DEFAULT_THREADS, reuse_port=False, store_config=None,
+          keepalive_timeout=KEEPALIVE_TIMEOUT, keepalive_max_requests=KEEPALIVE_MAX_REQUESTS, max_in_flight=None,
+          max_heavy_cost=MAX_HEAVY_COST, max_pending=MAX_PENDING, backlog=BACKLOG):
+    # every worker process gets its own connection to the storage
+    MainHTTPHandler.store = Store(**(store_config or {}))
+    MainHTTPHandler.timeout = keepalive_timeout
+    MainHTTPHandler.max_requests = keepalive_max_requests
+    MainHTTPHandler.admission = AdmissionControl(max_in_flight or threads, max_heavy_cost=max_heavy_cost)
+    server = ThreadPoolHTTPServer(("localhost", port), MainHTTPHandler, threads=threads, reuse_port=reuse_port,
+                                  backlog=backlog, max_pending=max_pending)
+    if threading.current_thread() is threading.main_thread():
+        # stopped by its master or a supervisor, the server finishes the requests it has and flushes the cache;
+        # shutdown() waits for serve_forever() to return, so it can't be called right in the handler
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    logging.info("Starting server at %s (pid %s, %s threads)", port, os.getpid(), threads)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
     server.server_close()
+    # cache writes still queued go out before the worker exits
+    MainHTTPHandler.store.close()
+    logging.info("Server at %s stopped (pid %s)", port, os.getpid())
+
+
+def stop_workers(children):
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def wait_workers(children):
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+
+def serve_workers(port, workers, **serve_options):
+    children = []
+    # a supervisor stops the master with SIGTERM: the workers are stopped the same way and waited for,
+    # so none of them is left holding the port
+    previous = signal.signal(signal.SIGTERM, lambda signum, frame: stop_workers(children))
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                serve(port, reuse_port=True, **serve_options)
+            except Exception:
+                logging.exception("Worker %s failed", os.getpid())
+                code = 1
+            finally:
+                logs.stop()
+                os._exit(code)
+        children.append(pid)
+
+    logging.info("Started %s workers: %s", workers, children)
+    try:
+        wait_workers(children)
+    except KeyboardInterrupt:
+        stop_workers(children)
+        wait_workers(children)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8089)
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-w", "--workers", action="store", type=int, default=1)
+    op.add_option("-t", "--threads", action="store", type=int, default=DEFAULT_THREADS)
+    op.add_option("--json-codec", action="store", default=None, choices=sorted(codec.CODECS))
+    op.add_option("--keepalive-timeout", action="store", type=int, default=KEEPALIVE_TIMEOUT)
+    op.add_option("--keepalive-max-requests", action="store", type=int, default=KEEPALIVE_MAX_REQUESTS)
+    op.add_option("--score-lock", action="store_true", default=False)
+    op.add_option("--no-legacy-score-keys", action="store_true", default=False)
+    op.add_option("--cache-write-behind", action="store", type=int, default=0)
+    op.add_option("--max-in-flight", action="store", type=int, default=None)
+    op.add_option("--max-heavy-cost", action="store", type=int, default=MAX_HEAVY_COST)
+    op.add_option("--max-pending", action="store", type=int, default=MAX_PENDING)
+    op.add_option("--backlog", action="store", type=int, default=BACKLOG)
+    add_store_options(op)
+    logs.add_logging_options(op)
+    (opts, args) = op.parse_args()
+    logs.setup_logging_from_options(opts)
+    scoring.check_score_key_secret()
+    codec.use(opts.json_codec)
+    logging.info("Using %s JSON codec", codec.codec.name)
+    if opts.score_lock:
+        scoring.score_lock = scoring.StoreLock()
+    if opts.no_legacy_score_keys:
+        scoring.LEGACY_KEY_FALLBACK = False
+    serve_options = {
+        "threads": opts.threads,
+        "store_config": dict(store_config_from_options(opts), write_behind=opts.cache_write_behind),
+        "keepalive_timeout": opts.keepalive_timeout,
+        "keepalive_max_requests": opts.keepalive_max_requests,
+        "max_in_flight": opts.max_in_flight,
+        "max_heavy_cost": opts.max_heavy_cost,
+        "max_pending": opts.max_pending,
+        "backlog": opts.backlog,
+    }
+    if opts.workers > 1:
+        serve_workers(opts.port, opts.workers, **serve_options)
+    else:
+        serve(opts.port, **serve_options)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import uuid
+from http import HTTPStatus
+from optparse import OptionParser
+
+from api import MethodRequest, OnlineScoreRequest, ClientsInterestsRequest, ValidationError, check_auth, \
+    build_response, OK, BAD_REQUEST, FORBIDDEN, NOT_FOUND, INVALID_REQUEST, INTERNAL_ERROR
+import codec
+import logs
+from async_store import AsyncStore
+from store import add_store_options, store_config_from_options
+from scoring import get_score_async, get_interests_bulk_async, check_score_key_secret
+
+IDLE_TIMEOUT = 30
+MAX_HEADERS = 100
+
+
+async def method_handler(request, ctx, store):
+    methods = {
+        'online_score': online_score_handler,
+        'clients_interests': clients_interests_handler
+    }
+    try:
+        request = MethodRequest(**request.get("body"))
+
+        if not check_auth(request):
+            logging.error("Wrong authentication token")
+            return None, FORBIDDEN, ctx
+
+        return await methods[request.method](request, ctx, store)
+
+    except ValidationError as e:
+        logging.error("Validation error: %s", e.message)
+        return {'msg': 'validation error'}, INVALID_REQUEST, ctx
+
+
+async def online_score_handler(request: MethodRequest, ctx, store):
+    if request.is_admin:
+        score = 42
+    else:
+        request = OnlineScoreRequest(**request.arguments)
+        ctx['has'] = request.has
+        score = await get_score_async(store, phone=request.phone,
+                                      email=request.email, birthday=request.birthday,
+                                      gender=request.gender, first_name=request.first_name,
+                                      last_name=request.last_name)
+    return {"score": score}, OK, ctx
+
+
+async def clients_interests_handler(request: MethodRequest, ctx, store):
+    request = ClientsInterestsRequest(**request.arguments)
+    interests = await get_interests_bulk_async(store, request.client_ids)
+    response = {str(cid): interests[cid] for cid in request.client_ids}
+    ctx.update({"nclients": len(response)})
+    return response, OK, ctx
+
+
+class AsyncHTTPServer:
+    """ HTTP/1.1 front end on asyncio: every connection is a coroutine, not a thread """
+    router = {
+        "method": method_handler
+    }
+
+    def __init__(self, store, host="localhost", port=8089, idle_timeout=IDLE_TIMEOUT):
+        self.store = store
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            keep_alive = True
+            while keep_alive:
+                keep_alive = await self.handle_one_request(reader, writer)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.exception("Unexpected error: %s", e)
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        if not request_line:
+            return None
+        method, path, version = request_line.decode("latin-1").split()
+        headers = {}
+        for _ in range(MAX_HEADERS):
+            line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return method, path, version, headers
+
+    async def handle_one_request(self, reader, writer):
+        try:
+            request = await self.read_request(reader)
+        except ValueError:
+            await self.write_response(writer, BAD_REQUEST, build_response(None, BAD_REQUEST), keep_alive=False)
+            return False
+        if request is None:
+            return False
+        method, path, version, headers = request
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+        if method != "POST":
+            code = HTTPStatus.NOT_IMPLEMENTED
+            await self.write_response(writer, code, {"error": code.phrase, "code": code.value}, keep_alive=False)
+            return False
+
+        response, code = {}, OK
+        context = {"request_id": headers.get("x-request-id", uuid.uuid4().hex)}
+        body = None
+        try:
+            data = await asyncio.wait_for(reader.readexactly(int(headers["content-length"])), self.idle_timeout)
+            body = codec.loads(data)
+        except (KeyError, ValueError):
+            code = BAD_REQUEST
+            keep_alive = False
+
+        if body or (body == {}):
+            route = path.strip("/")
+            logs.log_body(path, body, context["request_id"])
+            if route in self.router:
+                try:
+                    response, code, context = await self.router[route]({"body": body, "headers": headers},
+                                                                       context, self.store)
+                except Exception as e:
+                    logging.exception("Unexpected error: %s", e)
+                    code = INTERNAL_ERROR
+            else:
+                code = NOT_FOUND
+
+        r = build_response(response, code)
+        context.update(r)
+        await self.write_response(writer, code, r, keep_alive)
+        logs.log_request(context)
+        return keep_alive
+
+    async def write_response(self, writer, code, r, keep_alive):
+        body = codec.dumps(r)
+        head = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % (
+            code, HTTPStatus(code).phrase, len(body), "keep-alive" if keep_alive else "close")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+
+async def main(opts):
+    store = AsyncStore(**store_config_from_options(opts))
+    server = AsyncHTTPServer(store, port=opts.port)
+    await server.start()
+    logging.info("Starting asyncio server at %s", server.port)
+    try:
+        await server.serve_forever()
+    finally:
+        await store.close()
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8089)
+    op.add_option("-l", "--log", action="store", default=None)
+    add_store_options(op)
+    logs.add_logging_options(op)
+    (opts, args) = op.parse_args()
+    logs.setup_logging_from_options(opts)
+    check_score_key_secret()
+    try:
+        asyncio.run(main(opts))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import socket
+import time
+
+import redis
+
+from cache import TTLCache
+from retry import RetryPolicy, CircuitBreaker, CircuitOpenError
+from local_store import AsyncLocalRedis
+from store import GET_MANY_CHUNK, STORE_DEFAULTS, STORE_ERRORS, MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, \
+    RETRY_BUDGET, BREAKER_THRESHOLD, BREAKER_RESET_TIMEOUT, NEGATIVE_CACHE_SIZE, NEGATIVE_TTL, BACKEND_DEFAULTS, \
+    keepalive_options
+
+
+class AsyncRedisClient:
+    """ Minimal asyncio Redis client speaking RESP over a small pool of connections """
+
+    def __init__(self, host="localhost", port=6379, db=0, connect_timeout=None, socket_timeout=None,
+                 max_connections=50, pool_timeout=None, keepalive=False, health_check_interval=0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.connect_timeout = connect_timeout
+        self.socket_timeout = socket_timeout
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.keepalive = keepalive
+        self.health_check_interval = health_check_interval
+        self.created = 0
+        # idle connections as (reader, writer, last_used) tuples, most recently used last
+        self._idle = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def _connect(self):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                    self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise redis.exceptions.ConnectionError("Error connecting to %s:%s. %s" % (self.host, self.port, e))
+        if self.keepalive:
+            sock = writer.get_extra_info("socket")
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for option, value in keepalive_options().items():
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+        self.created += 1
+        if self.db:
+            writer.write(self._pack("SELECT", self.db))
+            await self._read_reply(reader)
+        return reader, writer
+
+    async def _acquire(self):
+        while self._idle:
+            reader, writer, last_used = self._idle.pop()
+            if not self.health_check_interval or time.monotonic() - last_used < self.health_check_interval:
+                return reader, writer
+            # connection was idle for a while, make sure it is still alive before handing it out
+            try:
+                writer.write(self._pack("PING"))
+                await asyncio.wait_for(self._read_reply(reader), self.socket_timeout)
+                return reader, writer
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, redis.exceptions.RedisError):
+                self._discard(writer)
+        return await self._connect()
+
+    def _release(self, reader, writer):
+        self._idle.append((reader, writer, time.monotonic()))
+
+    def _discard(self, writer):
+        self.created -= 1
+        writer.close()
+
+    @staticmethod
+    def _pack(*args):
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode("utf-8")
+            elif not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(out)
+
+    async def _read_reply(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise redis.exceptions.ConnectionError("Connection closed by server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            raise redis.exceptions.ResponseError(payload.decode("utf-8"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            return (await reader.readexactly(length + 2))[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply(reader) for _ in range(length)]
+        raise redis.exceptions.ConnectionError("Protocol error: %r" % line)
+
+    async def execute_command(self, *args):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.pool_timeout)
+        except asyncio.TimeoutError:
+            raise redis.exceptions.ConnectionError("Too many connections")
+        try:
+            reader, writer = await self._acquire()
+            try:
+                writer.write(self._pack(*args))
+                await writer.drain()
+                reply = await asyncio.wait_for(self._read_reply(reader), self.socket_timeout)
+            except redis.exceptions.ResponseError:
+                self._release(reader, writer)
+                raise
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    redis.exceptions.ConnectionError) as e:
+                self._discard(writer)
+                raise redis.exceptions.ConnectionError(str(e) or e.__class__.__name__)
+            self._release(reader, writer)
+            return reply
+        finally:
+            self._slots.release()
+
+    def pool_stats(self):
+        return {
+            "max_connections": self.max_connections,
+            "created": self.created,
+            "idle": len(self._idle),
+            "in_use": self.created - len(self._idle),
+        }
+
+    async def ping(self):
+        return await self.execute_command("PING") == "PONG"
+
+    async def get(self, key):
+        return await self.execute_command("GET", key)
+
+    async def set(self, key, value):
+        return await self.execute_command("SET", key, value) == "OK"
+
+    async def mget(self, keys):
+        return await self.execute_command("MGET", *keys)
+
+    async def setex(self, key, seconds, value):
+        return await self.execute_command("SETEX", key, seconds, value) == "OK"
+
+    async def delete(self, *keys):
+        return await self.execute_command("DEL", *keys)
+
+    async def close(self):
+        while self._idle:
+            _, writer, _ = self._idle.pop()
+            self._discard(writer)
+
+
+class AsyncStore:
+    """ Coroutine counterpart of store.Store with the same interface """
+
+    def __init__(self, host=STORE_DEFAULTS["host"], port=STORE_DEFAULTS["port"], db=STORE_DEFAULTS["db"],
+                 connect_timeout=STORE_DEFAULTS["connect_timeout"], socket_timeout=STORE_DEFAULTS["socket_timeout"],
+                 max_connections=STORE_DEFAULTS["max_connections"], pool_timeout=STORE_DEFAULTS["pool_timeout"],
+                 keepalive=STORE_DEFAULTS["keepalive"],
+                 health_check_interval=STORE_DEFAULTS["health_check_interval"],
+                 negative_cache_size=NEGATIVE_CACHE_SIZE, negative_ttl=NEGATIVE_TTL, retry_policy=None, breaker=None,
+                 backend=BACKEND_DEFAULTS["backend"], path=BACKEND_DEFAULTS["path"]):
+        if backend == "local":
+            self.client = AsyncLocalRedis(path or None)
+        elif backend == "redis":
+            self.client = AsyncRedisClient(host=host, port=port, db=db, connect_timeout=connect_timeout,
+                                           socket_timeout=socket_timeout, max_connections=max_connections,
+                                           pool_timeout=pool_timeout, keepalive=keepalive,
+                                           health_check_interval=health_check_interval)
+        else:
+            raise ValueError("Unknown storage backend: %s" % backend)
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                                                        max_delay=RETRY_MAX_DELAY, budget=RETRY_BUDGET,
+                                                        retry_on=STORE_ERRORS)
+        # no background probe here: once reset_timeout passes a single request goes through as a trial
+        self.breaker = breaker or CircuitBreaker(failure_threshold=BREAKER_THRESHOLD,
+                                                 reset_timeout=BREAKER_RESET_TIMEOUT, failure_on=STORE_ERRORS)
+        # absent keys, see store.Store
+        self.negative = TTLCache(maxsize=negative_cache_size, ttl=negative_ttl)
+        self._generation = 0
+
+    async def _retry(self, command, *args):
+        try:
+            return await self.retry_policy.call_async(self.breaker.call_async, command, *args)
+        except CircuitOpenError as e:
+            raise redis.exceptions.ConnectionError("Storage is unavailable: %s" % e)
+        except STORE_ERRORS as e:
+            logging.info("Cannot connect to Redis: %s", e)
+            raise redis.exceptions.ConnectionError(str(e))
+
+    async def ping(self):
+        return await self.client.ping()
+
+    def _remember_missing(self, keys, generation):
+        if generation == self._generation:
+            for key in keys:
+                self.negative.set(key, True)
+
+    def _forget_missing(self, keys):
+        self._generation += 1
+        for key in keys:
+            self.negative.delete(key)
+
+    async def set(self, key, value):
+        self._forget_missing([key])
+        try:
+            return await self._retry(self.client.set, key, value)
+        finally:
+            # a read that went to Redis before the write landed may have remembered the key meanwhile
+            self._forget_missing([key])
+
+    async def get(self, key: str):
+        if self.negative.get(key):
+            return None
+        generation = self._generation
+        value = await self._retry(self.client.get, key) or None
+        if value is None:
+            self._remember_missing([key], generation)
+        return value
+
+    async def get_many(self, keys):
+        keys = list(keys)
+        lookup = [key for key in keys if not self.negative.get(key)]
+        generation = self._generation
+        chunks = await asyncio.gather(*[self._retry(self.client.mget, lookup[i:i + GET_MANY_CHUNK])
+                                        for i in range(0, len(lookup), GET_MANY_CHUNK)])
+        found = dict(zip(lookup, (value for chunk in chunks for value in chunk)))
+        self._remember_missing([key for key, value in found.items() if not value], generation)
+        return [found.get(key) or None for key in keys]
+
+    async def delete(self, *keys):
+        self._forget_missing(keys)
+        try:
+            return await self._retry(self.client.delete, *keys)
+        finally:
+            self._forget_missing(keys)
+
+    async def cache_set(self, key: str, value, seconds_to_expire):
+        try:
+            return await self.breaker.call_async(self.client.setex, key, seconds_to_expire, value)
+        except CircuitOpenError as e:
+            raise redis.exceptions.ConnectionError("Storage is unavailable: %s" % e)
+
+    async def cache_get(self, key: str):
+        try:
+            return await self.breaker.call_async(self.client.get, key)
+        except Exception:
+            return None
+
+    def negative_cache_stats(self):
+        return self.negative.stats()
+
+    def pool_stats(self):
+        return self.client.pool_stats()
+
+    async def close(self):
+        await self.client.close()
@@ -0,0 +1,46 @@
+"""
+Performance benchmarks of the request path.
+
+Everything runs in-process on top of fakeredis, so no Redis server is needed:
+
+    $ python -m benchmarks -o bench.json
+    $ python -m benchmarks -o new.json --baseline bench.json
+"""
+import hashlib
+import json
+import datetime
+
+import fakeredis
+
+import api
+from store import Store
+
+
+def make_store(**kwargs):
+    """ Store backed by an in-memory fakeredis server """
+    store = Store(**kwargs)
+    store.client = fakeredis.FakeStrictRedis()
+    return store
+
+
+def make_request(arguments, method="online_score", login="h&f", account="horns&hoofs"):
+    request = {"account": account, "login": login, "method": method, "arguments": arguments}
+    if login == api.ADMIN_LOGIN:
+        msg = datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT
+    else:
+        msg = account + login + api.SALT
+    request["token"] = hashlib.sha512(msg.encode('utf-8')).hexdigest()
+    return request
+
+
+def populate_interests(store, cids):
+    interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+    for cid in cids:
+        store.client.set("i:%s" % cid, json.dumps(interests[cid % 5:cid % 5 + 3]))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(q / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
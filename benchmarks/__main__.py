@@ -0,0 +1,78 @@
+import datetime
+import json
+import platform
+import sys
+from optparse import OptionParser
+
+from benchmarks import micro, http_load
+
+
+def compare(results, baseline, threshold):
+    """ Names of the benchmarks that got slower than the baseline by more than threshold (a fraction) """
+    regressions = []
+    for name, result in results.get("micro", {}).items():
+        before = baseline.get("micro", {}).get(name)
+        if before and result["best_us"] > before["best_us"] * (1 + threshold):
+            regressions.append("%s: %.2fus -> %.2fus" % (name, before["best_us"], result["best_us"]))
+    http, before = results.get("http"), baseline.get("http")
+    if http and before:
+        if http["latency_ms"]["p99"] > before["latency_ms"]["p99"] * (1 + threshold):
+            regressions.append("http p99: %.2fms -> %.2fms" % (before["latency_ms"]["p99"], http["latency_ms"]["p99"]))
+        if http["throughput_rps"] < before["throughput_rps"] * (1 - threshold):
+            regressions.append("http throughput: %.0f -> %.0f rps" % (before["throughput_rps"],
+                                                                       http["throughput_rps"]))
+    return regressions
+
+
+def main():
+    op = OptionParser(usage="python -m benchmarks [options]")
+    op.add_option("-o", "--output", action="store", default=None, help="write results as JSON to this file")
+    op.add_option("--only", action="append", default=[], help="run micro benchmarks with this name prefix")
+    op.add_option("--no-micro", action="store_true", default=False)
+    op.add_option("--no-http", action="store_true", default=False)
+    op.add_option("--repeat", action="store", type=int, default=5)
+    op.add_option("--min-time", action="store", type=float, default=0.2)
+    op.add_option("--http-clients", action="store", type=int, default=8)
+    op.add_option("--http-threads", action="store", type=int, default=16)
+    op.add_option("--http-duration", action="store", type=float, default=5.0)
+    op.add_option("--baseline", action="store", default=None, help="JSON results of an earlier run to compare with")
+    op.add_option("--threshold", action="store", type=float, default=0.1)
+    (opts, args) = op.parse_args()
+
+    results = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+    }
+    if not opts.no_micro:
+        results["micro"] = micro.run(opts.only, repeat=opts.repeat, min_time=opts.min_time)
+        for name, result in results["micro"].items():
+            print("%-40s %12.2f us %14.0f ops/s" % (name, result["best_us"], result["ops_per_sec"]), file=sys.stderr)
+    if not opts.no_http:
+        results["http"] = http_load.run(clients=opts.http_clients, threads=opts.http_threads,
+                                        duration=opts.http_duration)
+        http = results["http"]
+        print("http: %d requests, %d errors, %.0f rps, p50 %.2fms p95 %.2fms p99 %.2fms" % (
+            http["requests"], http["errors"], http["throughput_rps"], http["latency_ms"]["p50"],
+            http["latency_ms"]["p95"], http["latency_ms"]["p99"]), file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if opts.output:
+        with open(opts.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            regressions = compare(results, json.load(f), opts.threshold)
+        for regression in regressions:
+            print("REGRESSION %s" % regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
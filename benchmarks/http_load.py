@@ -0,0 +1,97 @@
+import http.client
+import itertools
+import json
+import threading
+import time
+
+import api
+from benchmarks import make_store, make_request, populate_interests, percentile
+
+INTERESTS_CIDS = list(range(1000))
+
+
+class QuietHandler(api.MainHTTPHandler):
+    def log_message(self, *args):
+        pass
+
+
+def request_mix():
+    """ Request bodies the clients cycle through: mostly scoring, some interests lookups """
+    bodies = [
+        make_request({"phone": "79175002040", "email": "stupnikov@otus.ru"}),
+        make_request({"first_name": "a", "last_name": "b", "gender": 1, "birthday": "01.01.2000"}),
+        make_request({"phone": 79175002041, "email": "a@b"}),
+        make_request({"client_ids": INTERESTS_CIDS[:20]}, method="clients_interests"),
+    ]
+    return [json.dumps(body).encode("utf-8") for body in bodies]
+
+
+def client(port, bodies, deadline, max_requests, counter, latencies, errors):
+    conn = http.client.HTTPConnection("localhost", port, timeout=10)
+    for body in itertools.cycle(bodies):
+        if time.perf_counter() >= deadline or next(counter) >= max_requests:
+            break
+        started = time.perf_counter()
+        try:
+            conn.request("POST", "/method", body=body, headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != api.OK:
+                errors.append(resp.status)
+            if resp.will_close:
+                conn.close()
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e))
+            conn.close()
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+
+
+def run(clients=8, threads=16, duration=5.0, max_requests=None):
+    """ Loads MainHTTPHandler from `clients` keep-alive connections, reports throughput and latency """
+    store = make_store()
+    populate_interests(store, INTERESTS_CIDS)
+    QuietHandler.store = store
+    server = api.ThreadPoolHTTPServer(("localhost", 0), QuietHandler, threads=threads)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    bodies = request_mix()
+    latencies, errors = [], []
+    counter = itertools.count()
+    started = time.perf_counter()
+    deadline = started + duration
+    port = server.server_address[1]
+    workers = []
+    for i in range(clients):
+        # clients start at different points of the mix
+        shift = i % len(bodies)
+        workers.append(threading.Thread(target=client, args=(port, bodies[shift:] + bodies[:shift], deadline,
+                                                             max_requests or float("inf"), counter, latencies,
+                                                             errors)))
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    server.shutdown()
+    server.server_close()
+
+    latencies.sort()
+    ms = [t * 1000 for t in latencies]
+    return {
+        "clients": clients,
+        "threads": threads,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "duration_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": sum(ms) / len(ms) if ms else None,
+            "p50": percentile(ms, 50),
+            "p95": percentile(ms, 95),
+            "p99": percentile(ms, 99),
+            "max": ms[-1] if ms else None,
+        },
+    }
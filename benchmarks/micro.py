@@ -0,0 +1,76 @@
+import itertools
+import timeit
+
+import api
+from benchmarks import make_store, make_request, populate_interests
+from migrate_interests import migrate
+from scoring import get_score, get_interests, get_interests_bulk, get_score_key, get_legacy_score_key
+
+SCORE_ARGUMENTS = {"phone": "79175002040", "email": "stupnikov@otus.ru", "gender": 1, "birthday": "01.01.2000",
+                   "first_name": "a", "last_name": "b"}
+INTERESTS_CIDS = list(range(100))
+
+
+def bench(fn, repeat=5, min_time=0.2):
+    """ Runs fn in timed batches of at least min_time seconds, reports the best and the median batch """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    runs = sorted(t / number for t in timer.repeat(repeat, number))
+    return {
+        "ops_per_sec": 1.0 / runs[0],
+        "best_us": runs[0] * 1e6,
+        "median_us": runs[len(runs) // 2] * 1e6,
+        "loops": number,
+        "repeat": repeat,
+    }
+
+
+def benchmarks():
+    """ name -> callable; every callable is one operation of the request path """
+    store = make_store()
+    no_l1_store = make_store(l1_cache_size=0)
+    populate_interests(store, INTERESTS_CIDS)
+    packed_store = make_store()
+    populate_interests(packed_store, INTERESTS_CIDS)
+    migrate(packed_store)
+
+    method_body = make_request(SCORE_ARGUMENTS)
+    admin_body = make_request(SCORE_ARGUMENTS, login=api.ADMIN_LOGIN)
+    user_request = api.MethodRequest(**method_body)
+    admin_request = api.MethodRequest(**admin_body)
+    interests_body = make_request({"client_ids": INTERESTS_CIDS[:10]}, method="clients_interests")
+    profile = api.OnlineScoreRequest(**SCORE_ARGUMENTS)
+    score_kwargs = {"phone": profile.phone, "email": profile.email, "birthday": profile.birthday,
+                    "gender": profile.gender, "first_name": profile.first_name, "last_name": profile.last_name}
+    get_score(store, **score_kwargs)
+    get_score(no_l1_store, **score_kwargs)
+    unique = itertools.count()
+
+    return {
+        "validation.method_request": lambda: api.MethodRequest(**method_body),
+        "validation.online_score_request": lambda: api.OnlineScoreRequest(**SCORE_ARGUMENTS),
+        "auth.user": lambda: api.check_auth(user_request),
+        "auth.admin": lambda: api.check_auth(admin_request),
+        "score_key.v2": lambda: get_score_key(**score_kwargs),
+        "score_key.legacy": lambda: get_legacy_score_key(profile.phone, profile.birthday, profile.first_name,
+                                                         profile.last_name),
+        "get_score.cache_hit": lambda: get_score(store, **score_kwargs),
+        "get_score.cache_hit_redis": lambda: get_score(no_l1_store, **score_kwargs),
+        "get_score.cache_miss": lambda: get_score(store, **dict(score_kwargs, first_name=str(next(unique)))),
+        "get_interests.one": lambda: get_interests(store, 1),
+        "get_interests.bulk_100": lambda: get_interests_bulk(store, INTERESTS_CIDS),
+        "get_interests.bulk_100_packed": lambda: get_interests_bulk(packed_store, INTERESTS_CIDS),
+        "method_handler.online_score": lambda: api.method_handler({"body": method_body, "headers": {}}, {}, store),
+        "method_handler.clients_interests_10": lambda: api.method_handler({"body": interests_body, "headers": {}},
+                                                                          {}, store),
+    }
+
+
+def run(names=None, repeat=5, min_time=0.2):
+    results = {}
+    for name, fn in benchmarks().items():
+        if names and not any(name.startswith(n) for n in names):
+            continue
+        results[name] = bench(fn, repeat=repeat, min_time=min_time)
+    return results
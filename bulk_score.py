@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Scores a JSONL file of profiles without going through HTTP.
+
+Every input line holds the arguments of an online_score request; every output
+line holds {"line": n, "score": ...} or {"line": n, "error": ..., "code": ...},
+in input order. Lines are scored in chunks by a pool of worker processes, each
+with a storage connection of its own and one cache read and write per chunk.
+At most a window of chunks is in flight, so memory does not grow with the input.
+"""
+import functools
+import logging
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from optparse import OptionParser
+
+import codec
+from api import score_items, INVALID_REQUEST
+from scoring import check_score_key_secret
+from store import Store, add_store_options, store_config_from_options
+
+CHUNK_SIZE = 500
+# chunks in flight per worker process
+WINDOW_PER_WORKER = 2
+PROGRESS_INTERVAL = 10
+
+_store = None
+
+
+def init_worker(store_factory):
+    global _store
+    _store = store_factory()
+
+
+def score_chunk(chunk, store=None):
+    """ Output lines for a chunk of numbered input lines """
+    results, valid, items = [], [], []
+    for n, line in chunk:
+        try:
+            items.append(codec.loads(line))
+        except ValueError:
+            results.append({"line": n, "error": "Invalid JSON", "code": INVALID_REQUEST})
+            continue
+        results.append({"line": n})
+        valid.append(len(results) - 1)
+    for i, result in zip(valid, score_items(store or _store, items)):
+        results[i].update(result)
+    return b"".join(codec.dumps(result) + b"\n" for result in results)
+
+
+def chunks(lines, chunk_size):
+    """ Lists of (line number, line) for non-blank lines, counting from 1 """
+    numbered = ((n, line) for n, line in enumerate(lines, 1) if line.strip())
+    while True:
+        chunk = list(islice(numbered, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Progress:
+    def __init__(self, interval=PROGRESS_INTERVAL, timer=time.monotonic):
+        self.interval = interval
+        self.timer = timer
+        self.started = self.reported = timer()
+        self.lines = 0
+
+    def add(self, lines):
+        self.lines += lines
+        if self.timer() - self.reported >= self.interval:
+            self.report()
+
+    def report(self):
+        self.reported = self.timer()
+        elapsed = self.reported - self.started
+        logging.info("Scored %s lines in %.1f s, %.0f lines/s", self.lines, elapsed,
+                     self.lines / elapsed if elapsed else 0)
+
+
+def run(lines, out, store_factory, workers=1, chunk_size=CHUNK_SIZE, progress=None):
+    """ Scores lines into the binary stream out, returns the number of lines scored;
+    with no workers chunks are scored in this process """
+    progress = progress or Progress()
+
+    def write(count, data):
+        out.write(data)
+        progress.add(count)
+
+    if workers <= 0:
+        store = store_factory()
+        for chunk in chunks(lines, chunk_size):
+            write(len(chunk), score_chunk(chunk, store))
+    else:
+        window = deque()
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(store_factory,)) as executor:
+            for chunk in chunks(lines, chunk_size):
+                if len(window) >= workers * WINDOW_PER_WORKER:
+                    write(*_result(window.popleft()))
+                window.append((len(chunk), executor.submit(score_chunk, chunk)))
+            while window:
+                write(*_result(window.popleft()))
+    out.flush()
+    progress.report()
+    return progress.lines
+
+
+def _result(pending):
+    count, future = pending
+    return count, future.result()
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [input.jsonl|-] [output.jsonl|-]")
+    op.add_option("-w", "--workers", action="store", type=int, default=1)
+    op.add_option("--chunk-size", action="store", type=int, default=CHUNK_SIZE)
+    op.add_option("--progress-interval", action="store", type=float, default=PROGRESS_INTERVAL)
+    op.add_option("-l", "--log", action="store", default=None)
+    add_store_options(op)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    check_score_key_secret()
+    source = args[0] if len(args) > 0 else "-"
+    target = args[1] if len(args) > 1 else "-"
+    infile = sys.stdin.buffer if source == "-" else open(source, "rb")
+    outfile = sys.stdout.buffer if target == "-" else open(target, "wb")
+    try:
+        run(infile, outfile, functools.partial(Store, **store_config_from_options(opts)), workers=opts.workers,
+            chunk_size=opts.chunk_size, progress=Progress(opts.progress_interval))
+    finally:
+        infile.close()
+        outfile.close()
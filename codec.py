@@ -0,0 +1,66 @@
+"""
+JSON codec used for request bodies, responses and stored values.
+
+orjson is used when it is installed, the standard library otherwise; both turn
+objects into UTF-8 bytes, so responses go to the socket without a str copy.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibCodec:
+    name = "json"
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj).encode("utf-8")
+
+
+class OrjsonCodec:
+    name = "orjson"
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+
+CODECS = {StdlibCodec.name: StdlibCodec}
+if orjson is not None:
+    CODECS[OrjsonCodec.name] = OrjsonCodec
+
+
+def get_codec(name=None):
+    """ Codec by name, or the fastest one available """
+    if name is None:
+        name = OrjsonCodec.name if OrjsonCodec.name in CODECS else StdlibCodec.name
+    if name not in CODECS:
+        raise ValueError("JSON codec %s is not available, choose from %s" % (name, ", ".join(sorted(CODECS))))
+    return CODECS[name]()
+
+
+def use(name=None):
+    global codec
+    codec = get_codec(name)
+    return codec
+
+
+def loads(data):
+    return codec.loads(data)
+
+
+def dumps(obj):
+    return codec.dumps(obj)
+
+
+codec = get_codec()
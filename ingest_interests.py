@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Loads client interests from a CSV or JSONL dump into i:<cid> keys.
+
+JSONL lines look like {"cid": 1, "interests": ["sport", "books"]}; CSV rows
+hold the client ID followed by one interest per column, a header row is
+skipped. Records are written in chunks, each chunk with pipelined MSETs,
+several chunks at a time. Done chunks are recorded in a checkpoint file along
+with the size and modification time of the dump, so a failed load started
+again on the same dump goes on where it stopped; a new dump starts afresh.
+
+With --swap the load goes to keys of its own, i:<namespace>:<cid> (--namespace,
+a timestamp by default), and readers are switched over to them with a single
+write once every record is in place. Without it the load goes to the namespace
+readers use now.
+"""
+import csv
+import datetime
+import io
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from optparse import OptionParser
+
+import codec
+import interests
+from store import Store, add_store_options, store_config_from_options
+
+BATCH_SIZE = 1000
+PARALLEL = 4
+# chunks in flight per writer thread
+WINDOW_PER_WRITER = 2
+# readers keep using the previous namespace this long after a swap, its keys are dropped after that
+DROP_DELAY = interests.NAMESPACE_TTL + 1
+
+
+def read_jsonl(lines):
+    for line in lines:
+        if line.strip():
+            record = codec.loads(line)
+            yield record["cid"], record["interests"]
+
+
+def read_csv(lines):
+    for n, row in enumerate(csv.reader(io.TextIOWrapper(lines, encoding="utf-8", newline=""))):
+        if not row:
+            continue
+        try:
+            cid = int(row[0])
+        except ValueError:
+            if n == 0:
+                continue
+            raise ValueError("Invalid client ID in CSV row %s: %s" % (n + 1, row[0]))
+        yield cid, [name for name in row[1:] if name]
+
+
+READERS = {"jsonl": read_jsonl, "csv": read_csv}
+
+
+def source_identity(path):
+    """ What tells one dump from another under the same name """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+class Checkpoint:
+    """ Number of records of a dump already written and the namespace they went to, kept in a file;
+    a checkpoint left by another dump is ignored """
+
+    def __init__(self, path, source=None):
+        self.path = path
+        self.source = source
+        self.done = 0
+        self.namespace = None
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                state = codec.loads(f.read())
+            if state.get("source") == source:
+                self.done, self.namespace = state["done"], state["namespace"]
+            else:
+                logging.warning("Ignoring checkpoint %s left by another dump", path)
+
+    def save(self, done, namespace):
+        self.done, self.namespace = done, namespace
+        if not self.path:
+            return
+        temp = self.path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(codec.dumps({"done": done, "namespace": namespace, "source": self.source}))
+        os.replace(temp, self.path)
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def new_namespace():
+    return datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+
+
+def ingest(store, records, namespace=None, batch_size=BATCH_SIZE, parallel=PARALLEL, pack=False, checkpoint=None):
+    """ Writes (cid, names) records, skipping those the checkpoint has as done; returns stats """
+    checkpoint = checkpoint or Checkpoint(None)
+    stats = {"skipped": checkpoint.done, "written": 0, "namespace": namespace}
+    done = checkpoint.done
+    records = islice(records, checkpoint.done, None)
+    window = deque()
+
+    def finish(pending):
+        nonlocal done
+        count, future = pending
+        future.result()
+        done += count
+        stats["written"] += count
+        checkpoint.save(done, namespace)
+        logging.info("Written %s records", done)
+
+    with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="ingest") as executor:
+        try:
+            while True:
+                chunk = list(islice(records, batch_size))
+                if not chunk:
+                    break
+                # packing extends the shared vocabulary, so it is done here, one chunk at a time
+                rows = {interests.interests_key(cid, namespace): names for cid, names in chunk}
+                values = interests.pack_many(store, rows) if pack else \
+                    {key: codec.dumps(names) for key, names in rows.items()}
+                if len(window) >= parallel * WINDOW_PER_WRITER:
+                    finish(window.popleft())
+                window.append((len(chunk), executor.submit(store.set_many, values)))
+            while window:
+                finish(window.popleft())
+        finally:
+            for _, future in window:
+                future.cancel()
+    return stats
+
+
+def current_namespace(store):
+    value = store.get(interests.NAMESPACE_KEY)
+    return value.decode("utf-8") if value else None
+
+
+def switch_namespace(store, namespace):
+    """ Points readers to the namespace, returns the one they used before """
+    previous = current_namespace(store)
+    store.set(interests.NAMESPACE_KEY, namespace or "")
+    return previous
+
+
+def drop_namespace(store, namespace, batch_size=BATCH_SIZE):
+    """ Deletes the keys of a namespace; the plain i:<cid> keys when it is None """
+    prefix = interests.key_prefix(namespace)
+    deleted = 0
+    for keys in store.scan(prefix + "*", batch_size):
+        # i:* matches the keys of every namespace as well
+        keys = [key for key in keys if ":" not in key[len(prefix):]]
+        if keys:
+            store.delete(*keys)
+            deleted += len(keys)
+    return deleted
+
+
+def load(store, lines, fmt, namespace=None, swap=False, drop_previous=False, checkpoint=None, drop_delay=DROP_DELAY,
+         **options):
+    checkpoint = checkpoint or Checkpoint(None)
+    if checkpoint.done:
+        # a resumed load goes on in the namespace it started in
+        namespace = checkpoint.namespace
+    elif swap and not namespace:
+        namespace = new_namespace()
+    elif not swap and not namespace:
+        # after a swap readers no longer look at plain i:<cid> keys
+        namespace = current_namespace(store)
+    stats = ingest(store, READERS[fmt](lines), namespace=namespace, checkpoint=checkpoint, **options)
+    if swap:
+        previous = switch_namespace(store, namespace)
+        stats["previous"] = previous
+        logging.info("Readers switched from namespace %r to %r", previous, namespace)
+        if drop_previous and previous != namespace:
+            # other processes switch over only once their cached namespace expires
+            time.sleep(drop_delay)
+            stats["dropped"] = drop_namespace(store, previous)
+    checkpoint.remove()
+    return stats
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [dump.csv|dump.jsonl|-]")
+    op.add_option("--format", action="store", choices=sorted(READERS), default=None)
+    op.add_option("--batch-size", action="store", type=int, default=BATCH_SIZE)
+    op.add_option("--parallel", action="store", type=int, default=PARALLEL)
+    op.add_option("--pack", action="store_true", default=False)
+    op.add_option("--namespace", action="store", default=None)
+    op.add_option("--swap", action="store_true", default=False)
+    op.add_option("--drop-previous", action="store_true", default=False)
+    op.add_option("--checkpoint", action="store", default=None)
+    op.add_option("-l", "--log", action="store", default=None)
+    add_store_options(op)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    source = args[0] if args else "-"
+    fmt = opts.format or ("csv" if source.endswith(".csv") else "jsonl")
+    checkpoint_path = opts.checkpoint or (None if source == "-" else source + ".checkpoint")
+    identity = None if source == "-" else source_identity(source)
+    infile = sys.stdin.buffer if source == "-" else open(source, "rb")
+    try:
+        result = load(Store(**store_config_from_options(opts)), infile, fmt, namespace=opts.namespace,
+                      swap=opts.swap, drop_previous=opts.drop_previous,
+                      checkpoint=Checkpoint(checkpoint_path, identity), batch_size=opts.batch_size,
+                      parallel=opts.parallel, pack=opts.pack)
+    finally:
+        infile.close()
+    logging.info("Done: %s", result)
@@ -0,0 +1,256 @@
+"""
+Storage format of client interests under i:<cid>.
+
+Values are either JSON arrays of names (the original format) or packed arrays:
+a FORMAT_PACKED byte followed by little-endian uint16 IDs into a shared
+vocabulary of interest names kept under VOCABULARY_KEY. Readers accept both.
+
+A bulk load may write into a namespace of its own, i:<namespace>:<cid>, and
+switch readers over to it at once by writing the name under NAMESPACE_KEY.
+"""
+import sys
+import threading
+import time
+from array import array
+
+import codec
+
+KEY_PREFIX = "i:"
+VOCABULARY_KEY = "interests:vocabulary"
+# JSON values start with "[", so a control byte cannot be mistaken for one
+FORMAT_PACKED = b"\x01"
+MAX_VOCABULARY_SIZE = 1 << 16
+# how long a loaded vocabulary is trusted before it is read again
+VOCABULARY_TTL = 60
+DECODED_CACHE_SIZE = 10000
+VOCABULARY_LOCK_TTL = 10
+# name of the namespace readers use, none means plain i:<cid>
+NAMESPACE_KEY = "interests:namespace"
+# how long readers keep using a namespace after it has been switched
+NAMESPACE_TTL = 5
+
+
+def key_prefix(namespace=None):
+    return "%s%s:" % (KEY_PREFIX, namespace) if namespace else KEY_PREFIX
+
+
+def interests_key(cid, namespace=None):
+    return "%s%s" % (key_prefix(namespace), cid)
+
+
+class NamespaceCache:
+    """ Namespace readers use, read again after ttl seconds """
+
+    def __init__(self, ttl=NAMESPACE_TTL, timer=time.monotonic):
+        self.ttl = ttl
+        self.timer = timer
+        self.name = None
+        self.loaded_at = None
+
+    def is_fresh(self):
+        return self.loaded_at is not None and self.timer() - self.loaded_at < self.ttl
+
+    def update(self, value):
+        self.name = value.decode("utf-8") if isinstance(value, bytes) else value
+        self.loaded_at = self.timer()
+        return self.name
+
+    def get(self, store):
+        if self.is_fresh():
+            return self.name
+        return self.update(store.get(NAMESPACE_KEY))
+
+    async def get_async(self, store):
+        if self.is_fresh():
+            return self.name
+        return self.update(await store.get(NAMESPACE_KEY))
+
+    def clear(self):
+        self.name = None
+        self.loaded_at = None
+
+
+NAMESPACE = NamespaceCache()
+
+
+def keys(store, cids):
+    """ Keys of the clients in the namespace readers use now """
+    prefix = key_prefix(NAMESPACE.get(store))
+    return ["%s%s" % (prefix, cid) for cid in cids]
+
+
+async def keys_async(store, cids):
+    prefix = key_prefix(await NAMESPACE.get_async(store))
+    return ["%s%s" % (prefix, cid) for cid in cids]
+
+
+def is_packed(value):
+    return value[:1] == FORMAT_PACKED
+
+
+def unpack_ids(value):
+    ids = array("H")
+    ids.frombytes(value[1:])
+    if sys.byteorder != "little":
+        ids.byteswap()
+    return ids
+
+
+def pack(names, ids):
+    """ Packed value for a list of names, given a mapping of names to vocabulary IDs """
+    packed = array("H", [ids[name] for name in names])
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return FORMAT_PACKED + packed.tobytes()
+
+
+def decode(value, vocabulary=None):
+    """ List of interest names of a stored value; vocabulary is needed only for packed values """
+    if not value:
+        return []
+    if is_packed(value):
+        return [vocabulary[i] for i in unpack_ids(value)]
+    return codec.loads(value)
+
+
+class VocabularyCache:
+    """ Decoded vocabulary of a store, read again after ttl seconds or when a value refers to an unknown ID.
+
+    IDs never change once given, so packed values decoded with it are kept in a bounded cache
+    until the vocabulary turns out to be replaced rather than extended.
+    """
+
+    def __init__(self, ttl=VOCABULARY_TTL, decoded_size=DECODED_CACHE_SIZE, timer=time.monotonic):
+        self.ttl = ttl
+        self.decoded_size = decoded_size
+        self.timer = timer
+        self.names = []
+        self.loaded_at = None
+        self.loads = 0
+        self.decoded = {}
+        self._lock = threading.Lock()
+
+    def is_fresh(self, needed_id):
+        return (self.loaded_at is not None and needed_id < len(self.names)
+                and self.timer() - self.loaded_at < self.ttl)
+
+    def update(self, value):
+        names = codec.loads(value) if value else []
+        if names[:len(self.names)] != self.names:
+            self.decoded = {}
+        self.names = names
+        self.loaded_at = self.timer()
+        self.loads += 1
+        return self.names
+
+    def get(self, store, needed_id=-1):
+        if self.is_fresh(needed_id):
+            return self.names
+        with self._lock:
+            if self.is_fresh(needed_id):
+                return self.names
+            return self.update(store.get(VOCABULARY_KEY))
+
+    async def get_async(self, store, needed_id=-1):
+        if self.is_fresh(needed_id):
+            return self.names
+        return self.update(await store.get(VOCABULARY_KEY))
+
+    def remember(self, value, names):
+        if len(self.decoded) >= self.decoded_size:
+            self.decoded = {}
+        self.decoded[value] = names
+
+    def clear(self):
+        self.names = []
+        self.loaded_at = None
+        self.decoded = {}
+
+
+VOCABULARY = VocabularyCache()
+
+
+def _decode_known(values):
+    """ Decoded values, None in place of packed values that are not in the decode cache yet """
+    decoded = VOCABULARY.decoded
+    result, missing = [], []
+    for i, value in enumerate(values):
+        if not value:
+            result.append([])
+        elif value[:1] == FORMAT_PACKED:
+            names = decoded.get(value)
+            if names is None:
+                missing.append(i)
+            result.append(names)
+        else:
+            result.append(codec.loads(value))
+    return result, missing
+
+
+def _decode_missing(values, result, missing, vocabulary):
+    for i, ids in missing:
+        result[i] = names = tuple(vocabulary[n] for n in ids)
+        VOCABULARY.remember(values[i], names)
+    return _as_lists(result)
+
+
+def _as_lists(result):
+    # cached tuples are shared, callers get lists of their own
+    return [list(names) if isinstance(names, tuple) else names for names in result]
+
+
+def decode_many(store, values):
+    result, missing = _decode_known(values)
+    if not missing:
+        return _as_lists(result)
+    missing = [(i, unpack_ids(values[i])) for i in missing]
+    vocabulary = VOCABULARY.get(store, max(max(ids, default=-1) for _, ids in missing))
+    return _decode_missing(values, result, missing, vocabulary)
+
+
+async def decode_many_async(store, values):
+    result, missing = _decode_known(values)
+    if not missing:
+        return _as_lists(result)
+    missing = [(i, unpack_ids(values[i])) for i in missing]
+    vocabulary = await VOCABULARY.get_async(store, max(max(ids, default=-1) for _, ids in missing))
+    return _decode_missing(values, result, missing, vocabulary)
+
+
+def add_names(vocabulary, names):
+    """ Appends the names missing from the vocabulary list to it, returns the IDs of all its names """
+    known = set(vocabulary)
+    new = [name for name in dict.fromkeys(names) if name not in known]
+    if len(vocabulary) + len(new) > MAX_VOCABULARY_SIZE:
+        raise ValueError("Interest vocabulary is full: %s names" % (len(vocabulary) + len(new)))
+    vocabulary.extend(new)
+    return {name: i for i, name in enumerate(vocabulary)}
+
+
+def extend_vocabulary(store, names):
+    """ IDs of all names, adding the new ones to the stored vocabulary; IDs once given never change.
+    Callers writing concurrently must hold a lock around it """
+    vocabulary = list(VOCABULARY.update(store.get(VOCABULARY_KEY)))
+    size = len(vocabulary)
+    ids = add_names(vocabulary, names)
+    if len(vocabulary) > size:
+        # the vocabulary is written before any value that refers to it
+        value = codec.dumps(vocabulary)
+        store.set(VOCABULARY_KEY, value)
+        VOCABULARY.update(value)
+    return ids
+
+
+def pack_many(store, rows, lock_ttl=VOCABULARY_LOCK_TTL):
+    """ Packed values for a mapping of keys to lists of names, extending the vocabulary under a store lock """
+    if not rows:
+        return {}
+    lock = "lock:" + VOCABULARY_KEY
+    token = store.lock(lock, lock_ttl)
+    if token is None:
+        raise RuntimeError("Interest vocabulary is locked by another writer")
+    try:
+        ids = extend_vocabulary(store, [name for names in rows.values() for name in names])
+    finally:
+        store.unlock(lock, token)
+    return {key: pack(names, ids) for key, names in rows.items()}
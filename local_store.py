@@ -0,0 +1,385 @@
+"""
+Embedded storage backend: the part of the redis.Redis client API that Store
+uses, served from a dict in this process instead of a Redis server.
+
+With a path the data is also kept in an append-only log file. Every write is
+appended to it under a file lock, and every call first replays what other
+processes have appended since, reading the file through mmap, so worker
+processes on one host share the data and it outlives restarts. Once the log is
+mostly overwritten or deleted entries it is rewritten with the live ones only.
+Expiry times are wall clock, so they mean the same in every process.
+"""
+import fcntl
+import fnmatch
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+
+# operation, expiry in ms since the epoch (0 for none), key length, value length
+RECORD = struct.Struct("<cqII")
+SET = b"S"
+DELETE = b"D"
+# the log is rewritten when it is bigger than this and COMPACT_RATIO times the live data
+COMPACT_MIN_BYTES = 4 << 20
+COMPACT_RATIO = 2
+# key lists of SCAN iterations kept for their cursors
+SCAN_SNAPSHOTS = 4
+
+
+def encode(value):
+    """ Bytes the way redis-py sends a key or value """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    if isinstance(value, float):
+        return repr(value).encode("utf-8")
+    return str(value).encode("utf-8")
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class LocalRedis:
+    """ In-process stand-in for redis.Redis; shared through the log file at path if one is given """
+
+    def __init__(self, path=None, compact_min_bytes=COMPACT_MIN_BYTES):
+        self.path = path
+        self.compact_min_bytes = compact_min_bytes
+        # key -> (value, expiry in ms or 0)
+        self.data = {}
+        # (expiry, key) of keys with an expiry; entries outdated by later writes are skipped
+        self.expiries = []
+        self.live_bytes = 0
+        self._lock = threading.RLock()
+        # nesting depth of _exclusive() in the thread holding the lock
+        self._held = 0
+        self._scans = {}
+        self._scan_ids = itertools.count(1)
+        self._pid = None
+        self._fd = self._lock_fd = None
+        self._inode = None
+        self._offset = 0
+        if path:
+            self._open()
+
+    # log file
+
+    def _open(self):
+        """ (Re)opens the files after a fork, and the log alone after a compaction """
+        if self._pid != os.getpid():
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+            self._pid = os.getpid()
+            self._lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._inode = os.fstat(self._fd).st_ino
+        self.data, self.expiries, self.live_bytes, self._offset = {}, [], 0, 0
+        self._replay()
+
+    def _close_files(self):
+        for fd in (self._fd, self._lock_fd):
+            if fd is not None:
+                os.close(fd)
+        self._fd = self._lock_fd = None
+        self._pid = None
+
+    def _sync(self):
+        """ Applies what other processes have written since the last call """
+        if not self.path:
+            return
+        if self._pid != os.getpid():
+            # a forked child must not share the lock and the file offset with its parent
+            self._open()
+            return
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or stat.st_ino != self._inode:
+            # the log has been compacted by another process
+            self._open()
+        elif stat.st_size > self._offset:
+            self._replay()
+
+    def _replay(self):
+        size = os.fstat(self._fd).st_size
+        if size <= self._offset:
+            return
+        with mmap.mmap(self._fd, size, prot=mmap.PROT_READ) as log:
+            offset, current = self._offset, now_ms()
+            while offset + RECORD.size <= size:
+                op, expiry, key_length, value_length = RECORD.unpack_from(log, offset)
+                end = offset + RECORD.size + key_length + value_length
+                if end > size:
+                    # the rest of the record is still being written
+                    break
+                key = log[offset + RECORD.size:offset + RECORD.size + key_length]
+                if op == DELETE or (expiry and expiry <= current):
+                    self._drop(key)
+                else:
+                    self._put(key, log[end - value_length:end], expiry)
+                offset = end
+        self._offset = offset
+
+    def _append(self, records):
+        """ Writes records to the log; the caller holds the file lock and has synced """
+        if not self.path:
+            return
+        data = b"".join(RECORD.pack(op, expiry, len(key), len(value)) + key + value
+                        for op, key, value, expiry in records)
+        os.write(self._fd, data)
+        self._offset += len(data)
+        if self._offset > self.compact_min_bytes and self._offset > COMPACT_RATIO * self.live_bytes:
+            self._compact()
+
+    def _compact(self):
+        self._expire()
+        temp = "%s.%s.tmp" % (self.path, os.getpid())
+        with open(temp, "wb") as f:
+            for key, (value, expiry) in self.data.items():
+                f.write(RECORD.pack(SET, expiry, len(key), len(value)) + key + value)
+        os.replace(temp, self.path)
+        os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+        self._inode = os.fstat(self._fd).st_ino
+        self._offset = os.fstat(self._fd).st_size
+
+    def _write(self, records):
+        """ Applies (op, key, value, expiry) records here and in the log """
+        for op, key, value, expiry in records:
+            if op == DELETE:
+                self._drop(key)
+            else:
+                self._put(key, value, expiry)
+        self._append(records)
+
+    @contextmanager
+    def _exclusive(self):
+        """ Holds the thread lock and, with a log file, an exclusive lock on it for other processes """
+        with self._lock:
+            self._sync()
+            if not self.path or self._held:
+                self._held += 1
+                try:
+                    yield
+                finally:
+                    self._held -= 1
+                return
+            fd = self._lock_fd
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self._held += 1
+            try:
+                # catch up with what was written before the lock was taken
+                self._sync()
+                yield
+            finally:
+                self._held -= 1
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    # in-memory data
+
+    def _put(self, key, value, expiry):
+        self._drop(key)
+        self.data[key] = (value, expiry)
+        self.live_bytes += RECORD.size + len(key) + len(value)
+        if expiry:
+            heapq.heappush(self.expiries, (expiry, key))
+
+    def _drop(self, key):
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.live_bytes -= RECORD.size + len(key) + len(entry[0])
+        return entry is not None
+
+    def _expire(self):
+        current = now_ms()
+        while self.expiries and self.expiries[0][0] <= current:
+            expiry, key = heapq.heappop(self.expiries)
+            entry = self.data.get(key)
+            if entry is not None and entry[1] == expiry:
+                self._drop(key)
+
+    def _get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[1] and entry[1] <= now_ms():
+            self._drop(key)
+            return None
+        return entry
+
+    # redis.Redis commands
+
+    def ping(self):
+        return True
+
+    def get(self, key):
+        with self._lock:
+            self._sync()
+            entry = self._get(encode(key))
+            return entry[0] if entry else None
+
+    def mget(self, keys):
+        with self._lock:
+            self._sync()
+            return [entry[0] if entry else None for entry in map(self._get, map(encode, keys))]
+
+    def pttl(self, key):
+        with self._lock:
+            self._sync()
+            entry = self._get(encode(key))
+            if entry is None:
+                return -2
+            return max(entry[1] - now_ms(), 0) if entry[1] else -1
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        expiry = now_ms() + int(ex * 1000) if ex else now_ms() + int(px) if px else 0
+        key = encode(key)
+        with self._exclusive():
+            self._expire()
+            if nx and self._get(key) is not None:
+                return None
+            self._write([(SET, key, encode(value), expiry)])
+            return True
+
+    def setex(self, key, seconds_to_expire, value):
+        return self.set(key, value, ex=seconds_to_expire)
+
+    def mset(self, mapping):
+        with self._exclusive():
+            self._expire()
+            self._write([(SET, encode(key), encode(value), 0) for key, value in mapping.items()])
+            return True
+
+    def delete(self, *keys):
+        with self._exclusive():
+            found = [key for key in map(encode, keys) if self._get(key) is not None]
+            self._write([(DELETE, key, b"", 0) for key in found])
+            return len(found)
+
+    def scan(self, cursor=0, match=None, count=None):
+        """ Keys matching the pattern, count at a time; the cursor points into a list of them taken at cursor 0 """
+        count = count or 10
+        with self._lock:
+            if not cursor:
+                self._sync()
+                self._expire()
+                pattern = encode(match) if match is not None else None
+                keys = [key for key in self.data if pattern is None or fnmatch.fnmatchcase(key, pattern)]
+                scan_id, position = next(self._scan_ids), 0
+                self._scans[scan_id] = keys
+                while len(self._scans) > SCAN_SNAPSHOTS:
+                    del self._scans[next(iter(self._scans))]
+            else:
+                scan_id, position = divmod(cursor, 1 << 32)
+                keys = self._scans.get(scan_id)
+                if keys is None:
+                    raise redis.exceptions.ResponseError("invalid cursor")
+            end = position + count
+            if end >= len(keys):
+                self._scans.pop(scan_id, None)
+                return 0, keys[position:]
+            return scan_id << 32 | end, keys[position:end]
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self)
+
+    def flushall(self):
+        with self._exclusive():
+            self._write([(DELETE, key, b"", 0) for key in list(self.data)])
+            return True
+
+    def close(self):
+        with self._lock:
+            if self.path:
+                self._close_files()
+
+
+class LocalPipeline:
+    """ Commands queued and run together, with WATCH/MULTI for the optimistic locking Store.unlock uses """
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+        self.watched = None
+        self.buffering = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+    def reset(self):
+        self.commands = []
+        self.watched = None
+        self.buffering = True
+
+    def watch(self, *keys):
+        # commands run at once until multi(), as with redis-py
+        self.watched = {key: self.client.get(key) for key in keys}
+        self.buffering = False
+        return True
+
+    def multi(self):
+        self.buffering = True
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+
+        def call(*args, **kwargs):
+            if not self.buffering:
+                return command(*args, **kwargs)
+            self.commands.append((command, args, kwargs))
+            return self
+        return call
+
+    def execute(self):
+        commands, watched = self.commands, self.watched
+        self.reset()
+        with self.client._exclusive():
+            if watched and any(self.client.get(key) != value for key, value in watched.items()):
+                raise redis.exceptions.WatchError("Watched variable changed.")
+            return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class AsyncLocalRedis:
+    """ LocalRedis behind the coroutine interface AsyncStore expects of its client """
+
+    def __init__(self, path=None):
+        self.local = LocalRedis(path)
+
+    async def ping(self):
+        return self.local.ping()
+
+    async def get(self, key):
+        return self.local.get(key)
+
+    async def mget(self, keys):
+        return self.local.mget(keys)
+
+    async def set(self, key, value):
+        return self.local.set(key, value)
+
+    async def setex(self, key, seconds_to_expire, value):
+        return self.local.setex(key, seconds_to_expire, value)
+
+    async def delete(self, *keys):
+        return self.local.delete(*keys)
+
+    def pool_stats(self):
+        return {}
+
+    async def close(self):
+        self.local.close()
@@ -0,0 +1,179 @@
+"""
+Logging setup of the servers.
+
+Records go through a bounded in-memory queue to a background thread that
+formats and writes them, so a request thread never waits for the disk;
+when the queue is full records are dropped and counted. Request bodies
+are logged for a sample of requests only, without the token and truncated.
+"""
+import atexit
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+
+import codec
+
+LOG_FORMAT = '[%(asctime)s] %(levelname).1s %(message)s'
+LOG_DATE_FORMAT = '%Y.%m.%d %H:%M:%S'
+QUEUE_SIZE = 10000
+# log the body of one request in BODY_SAMPLE_RATE, 0 turns body logging off
+BODY_SAMPLE_RATE = 100
+BODY_MAX_LENGTH = 1024
+REDACTED_FIELDS = ("token",)
+JSON_TYPES = (str, int, float, bool, type(None), list, dict)
+
+
+class TextFormatter(logging.Formatter):
+    """ Classic one-line format with structured fields appended as key=value pairs """
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join("%s=%s" % (key, value) for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, LOG_DATE_FORMAT),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        try:
+            return codec.dumps(entry).decode("utf-8")
+        except TypeError:
+            # a field the codec cannot encode is written as its str()
+            return codec.dumps({key: value if isinstance(value, JSON_TYPES) else str(value)
+                                for key, value in entry.items()}).decode("utf-8")
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Hands records over to the queue as they are and drops them when it is full """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # message formatting is left to the listener thread; a traceback is rendered now
+        # because it refers to frames that are gone by the time the record is written
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BodyPreview:
+    """ Request body for a log message, rendered only if the message is written """
+    __slots__ = ("body", "max_length")
+
+    def __init__(self, body, max_length=None):
+        self.body = body
+        self.max_length = BODY_MAX_LENGTH if max_length is None else max_length
+
+    def __str__(self):
+        body = self.body
+        if isinstance(body, dict):
+            body = {key: "***" if key in REDACTED_FIELDS else value for key, value in body.items()}
+        text = codec.dumps(body).decode("utf-8")
+        if len(text) > self.max_length:
+            return "%s... (%s chars)" % (text[:self.max_length], len(text))
+        return text
+
+
+_body_counter = itertools.count()
+_listener = None
+# queue handler and target of the current setup_logging(), for the writer of a forked child
+_handler = _target = None
+
+
+def sample_body():
+    """ True for one call in BODY_SAMPLE_RATE """
+    return BODY_SAMPLE_RATE > 0 and next(_body_counter) % BODY_SAMPLE_RATE == 0
+
+
+def log_body(path, body, request_id):
+    if sample_body() and logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("%s: %s %s", path, BodyPreview(body), request_id)
+
+
+def log_request(context):
+    """ One structured line per request; the response itself is left out """
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        fields = {key: value for key, value in context.items() if key != "response"}
+        logging.info("request", extra={"fields": fields})
+
+
+def add_logging_options(parser):
+    parser.add_option("--log-json", action="store_true", default=False)
+    parser.add_option("--log-body-sample-rate", action="store", type=int, default=BODY_SAMPLE_RATE)
+    parser.add_option("--log-body-max-length", action="store", type=int, default=BODY_MAX_LENGTH)
+    parser.add_option("--log-queue-size", action="store", type=int, default=QUEUE_SIZE)
+
+
+def setup_logging(filename=None, level=logging.INFO, json_lines=False, queue_size=QUEUE_SIZE,
+                  body_sample_rate=BODY_SAMPLE_RATE, body_max_length=BODY_MAX_LENGTH):
+    """ Routes the root logger through a queue to a background writer, returns the queue handler """
+    global BODY_SAMPLE_RATE, BODY_MAX_LENGTH
+    BODY_SAMPLE_RATE = body_sample_rate
+    BODY_MAX_LENGTH = body_max_length
+    target = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    target.setFormatter(JsonFormatter() if json_lines else TextFormatter(LOG_FORMAT, LOG_DATE_FORMAT))
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    stop()
+    start_listener(handler, target)
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    return handler
+
+
+def start_listener(handler, target):
+    global _listener, _handler, _target
+    _handler, _target = handler, target
+    handler.queue = queue.Queue(handler.queue.maxsize)
+    _listener = logging.handlers.QueueListener(handler.queue, target, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop():
+    """ Writes out what is left in the queue; for processes leaving through os._exit """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_in_child():
+    # a forked worker has no writer thread: it gets a queue and a writer of its own
+    global _listener
+    if _handler is not None:
+        _listener = None
+        start_listener(_handler, _target)
+
+
+atexit.register(stop)
+os.register_at_fork(after_in_child=_restart_in_child)
+
+
+def setup_logging_from_options(opts):
+    return setup_logging(opts.log, json_lines=opts.log_json, queue_size=opts.log_queue_size,
+                         body_sample_rate=opts.log_body_sample_rate, body_max_length=opts.log_body_max_length)
@@ -0,0 +1,153 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds; request stages are mostly sub-millisecond, storage calls may take up to the retry budget
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{%s}" % ",".join('%s="%s"' % (name, value) for (name, _), value in zip(pairs, escaped))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.type)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self.render_samples(key, value))
+        return lines
+
+    def render_samples(self, key, value):
+        return ["%s%s %s" % (self.name, format_labels(self.labelnames, key), float(value))]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels))
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket counts (last one is +Inf), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def render_samples(self, key, state):
+        counts, total, count = state
+        lines, cumulative = [], 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append("%s_bucket%s %s" % (self.name, format_labels(self.labelnames, key, [("le", le)]),
+                                             cumulative))
+        labels = format_labels(self.labelnames, key)
+        lines.append("%s_sum%s %s" % (self.name, labels, total))
+        lines.append("%s_count%s %s" % (self.name, labels, count))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = Histogram("scoring_request_duration_seconds", "Time to handle a request, from reading the body "
+                            "to writing the response", ("method", "code"))
+STAGE_SECONDS = Histogram("scoring_stage_duration_seconds", "Time spent in each stage of a request",
+                          ("stage", "method"))
+STORE_SECONDS = Histogram("scoring_store_duration_seconds", "Time of storage calls by operation", ("operation",))
+IN_FLIGHT = Gauge("scoring_requests_in_flight", "Requests being handled")
+REJECTED = Counter("scoring_rejected_requests_total", "Requests turned away with 503 because the server is busy",
+                   ("reason",))
+STORE_STATS = Gauge("scoring_store", "Storage cache, connection pool, circuit breaker and score "
+                                       "computation state", ("stat",))
+
+
+@contextmanager
+def timed(ctx, stage):
+    """ Records how long the block took under ctx["timings"][stage] """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        ctx.setdefault("timings", {})[stage] = time.perf_counter() - started
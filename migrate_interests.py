@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Rewrites i:<cid> values between the JSON and the packed vocabulary formats.
+
+Keys are read and written in batches; values already in the target format are
+left alone, so the tool can be stopped and run again. Values written by
+somebody else between the read and the write of a batch are overwritten.
+"""
+import logging
+from optparse import OptionParser
+
+import codec
+import interests
+from store import Store, add_store_options, store_config_from_options
+
+BATCH_SIZE = 1000
+
+
+def pack_batch(store, keys, values, vocabulary=None):
+    """ Packed values of the JSON ones; with a vocabulary list new names get IDs in it alone,
+    without touching the stored vocabulary """
+    rows = {key: codec.loads(value) for key, value in zip(keys, values) if value and not interests.is_packed(value)}
+    if vocabulary is None:
+        return interests.pack_many(store, rows)
+    ids = interests.add_names(vocabulary, [name for names in rows.values() for name in names])
+    return {key: interests.pack(names, ids) for key, names in rows.items()}
+
+
+def unpack_batch(store, keys, values, vocabulary=None):
+    packed = [(key, value) for key, value in zip(keys, values) if value and interests.is_packed(value)]
+    decoded = interests.decode_many(store, [value for _, value in packed])
+    return {key: codec.dumps(names) for (key, _), names in zip(packed, decoded)}
+
+
+def migrate(store, pack=True, batch_size=BATCH_SIZE, dry_run=False):
+    rewrite = pack_batch if pack else unpack_batch
+    # a dry run extends a copy of the vocabulary and writes nothing, not even the vocabulary lock
+    vocabulary = codec.loads(store.get(interests.VOCABULARY_KEY) or b"[]") if dry_run else None
+    stats = {"scanned": 0, "rewritten": 0, "bytes_before": 0, "bytes_after": 0}
+    for keys in store.scan(interests.KEY_PREFIX + "*", batch_size):
+        values = store.get_many(keys)
+        changes = rewrite(store, keys, values, vocabulary)
+        stats["scanned"] += len(keys)
+        stats["rewritten"] += len(changes)
+        before = dict(zip(keys, values))
+        stats["bytes_before"] += sum(len(before[key]) for key in changes)
+        stats["bytes_after"] += sum(len(value) for value in changes.values())
+        if not dry_run:
+            store.set_many(changes)
+        logging.info("Scanned %(scanned)s keys, rewrote %(rewritten)s", stats)
+    return stats
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [--unpack] [--batch-size N] [--dry-run] [redis options]")
+    op.add_option("--unpack", action="store_true", default=False)
+    op.add_option("--batch-size", action="store", type=int, default=BATCH_SIZE)
+    op.add_option("--dry-run", action="store_true", default=False)
+    op.add_option("-l", "--log", action="store", default=None)
+    add_store_options(op)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    result = migrate(Store(**store_config_from_options(opts)), pack=not opts.unpack, batch_size=opts.batch_size,
+                     dry_run=opts.dry_run)
+    logging.info("Done: %s", result)
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    """Raises when a call is rejected because the circuit is open"""
+
+
+class RetryPolicy:
+    """ Exponential backoff with full jitter, bounded by attempts and by a total time budget """
+
+    def __init__(self, max_attempts=3, base_delay=0.05, max_delay=0.5, budget=1.0, jitter=True,
+                 retry_on=(Exception,), sleep=time.sleep, timer=time.monotonic):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.jitter = jitter
+        self.retry_on = retry_on
+        self.sleep = sleep
+        self.timer = timer
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def next_delay(self, attempt, deadline, error):
+        """ Delay before the next attempt or None when it is time to give up """
+        if isinstance(error, CircuitOpenError) or not isinstance(error, self.retry_on):
+            return None
+        if attempt >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt)
+        if self.timer() + delay > deadline:
+            return None
+        logging.info("Attempt %s failed: %s, retrying in %.3fs ...", attempt, error, delay)
+        return delay
+
+    def call(self, fn, *args, **kwargs):
+        deadline = self.timer() + self.budget
+        attempt = 1
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                delay = self.next_delay(attempt, deadline, e)
+                if delay is None:
+                    raise
+            self.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, fn, *args, **kwargs):
+        deadline = self.timer() + self.budget
+        attempt = 1
+        while True:
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self.next_delay(attempt, deadline, e)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+class CircuitBreaker:
+    """ Fails fast after a run of failures until the protected service is back.
+
+    With a probe the breaker checks the service in a background thread every reset_timeout
+    seconds and closes once the probe succeeds; without one it lets a single trial call
+    through every reset_timeout seconds.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=5.0, probe=None, failure_on=(Exception,),
+                 timer=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.failure_on = failure_on
+        self.reset_timeout = reset_timeout
+        self.probe = probe
+        self.timer = timer
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.opens = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._closed.set()
+
+    def allow_request(self):
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.probe is None and self.timer() - self.opened_at >= self.reset_timeout:
+                # half-open: let this call through as a trial, hold the others for another period
+                self.opened_at = self.timer()
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self._lock:
+            if self.state == self.OPEN:
+                logging.info("Circuit closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._closed.set()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.CLOSED and self.failures >= self.failure_threshold:
+                self._open()
+
+    def record_error(self, error):
+        # errors the service answered with (bad arguments and the like) mean it is up
+        if isinstance(error, self.failure_on):
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def _open(self):
+        logging.error("Circuit opened after %s failures", self.failures)
+        self.state = self.OPEN
+        self.opened_at = self.timer()
+        self.opens += 1
+        self._closed.clear()
+        if self.probe is not None:
+            threading.Thread(target=self._probe_loop, name="circuit-probe", daemon=True).start()
+
+    def _probe_loop(self):
+        while not self._closed.wait(self.reset_timeout):
+            try:
+                self.probe()
+            except Exception as e:
+                logging.info("Circuit probe failed: %s", e)
+            else:
+                self.record_success()
+
+    def call(self, fn, *args, **kwargs):
+        if not self.allow_request():
+            raise CircuitOpenError("Circuit is open")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.record_error(e)
+            raise
+        self.record_success()
+        return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        if not self.allow_request():
+            raise CircuitOpenError("Circuit is open")
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            self.record_error(e)
+            raise
+        self.record_success()
+        return result
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+        }
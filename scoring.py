@@ -1,20 +1,68 @@
 import hashlib
-import json
+import logging
+import os
+import threading
+import time
 
+import interests
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+SCORE_TTL = 60 * 60
+# a worker holding the store-side lock must finish within this time or the lock is given up
+SCORE_LOCK_TTL = 5.0
+SCORE_LOCK_WAIT = 1.0
+SCORE_LOCK_POLL = 0.02
+
+
+SCORE_KEY_PREFIX = "uid:v2:"
+# keys the digest, so that nobody can pick profiles colliding with somebody else's key; the default is
+# public, so it only keeps keys apart from plain digests until SCORE_KEY_SECRET is set
+DEFAULT_SCORE_KEY_SECRET = b"scoring-uid-v2"
+SCORE_KEY_SECRET = os.environ.get("SCORE_KEY_SECRET", "").encode("utf-8") or DEFAULT_SCORE_KEY_SECRET
+SCORE_KEY_SEPARATOR = "\x1f"
+# read uid: keys written before the v2 scheme; they are gone within SCORE_TTL after the last old worker stops
+LEGACY_KEY_FALLBACK = True
+
+
+def check_score_key_secret():
+    """ Warns at startup when score keys are derived with the public default secret """
+    if SCORE_KEY_SECRET == DEFAULT_SCORE_KEY_SECRET:
+        logging.warning("SCORE_KEY_SECRET is not set: score cache keys use a public default key, "
+                        "so colliding profiles can be crafted")
+        return False
+    return True
+
+
+def _normalize(value):
+    return str(value).strip().lower() if value is not None else ""
+
+
+def get_score_key(phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+    """ Cache key of a profile: a keyed BLAKE2 digest over all the fields, delimited and normalized """
+    key_parts = (
+        _normalize(phone),
+        _normalize(email),
+        str(birthday.toordinal()) if birthday is not None else "",
+        _normalize(gender),
+        _normalize(first_name),
+        _normalize(last_name),
+    )
+    digest = hashlib.blake2b(SCORE_KEY_SEPARATOR.join(key_parts).encode("utf-8"), digest_size=16,
+                             key=SCORE_KEY_SECRET)
+    return SCORE_KEY_PREFIX + digest.hexdigest()
+
+
+def get_legacy_score_key(phone, birthday=None, first_name=None, last_name=None):
     key_parts = [
         first_name or "",
         last_name or "",
         phone or "",
         birthday.strftime("%Y%m%d") if birthday is not None else "",
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts).encode("utf-8")).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return float(score)
+    return "uid:" + hashlib.md5("".join(key_parts).encode("utf-8")).hexdigest()
+
+
+def calculate_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -23,11 +71,195 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
-    store.cache_set(key, str(score), 60 * 60)
+    return score
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """ Runs one call per key at a time: concurrent callers with the same key wait and share its result """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn(*args)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._flights)}
+
+
+class StoreLock:
+    """ Short lock in the store so that one worker process computes a key while the others wait
+    for its result to show up in the cache """
+
+    def __init__(self, ttl=SCORE_LOCK_TTL, wait=SCORE_LOCK_WAIT, poll=SCORE_LOCK_POLL):
+        self.ttl = ttl
+        self.wait = wait
+        self.poll = poll
+
+    def run(self, store, key, compute, read_cached):
+        try:
+            token = store.lock("lock:" + key, self.ttl)
+        except Exception as e:
+            logging.warning("Cannot lock %s: %s", key, e)
+            return compute()
+        if token is None:
+            deadline = time.monotonic() + self.wait
+            while time.monotonic() < deadline:
+                time.sleep(self.poll)
+                value = read_cached()
+                if value is not None:
+                    return value
+            # the lock holder is slow or gone, do not keep the request waiting any longer
+            return compute()
+        try:
+            # another worker may have filled the cache just before the lock was taken
+            value = read_cached()
+            return compute() if value is None else value
+        finally:
+            try:
+                store.unlock("lock:" + key, token)
+            except Exception as e:
+                logging.warning("Cannot unlock %s: %s", key, e)
+
+
+score_flight = SingleFlight()
+# set to a StoreLock to coalesce score computations across worker processes too
+score_lock = None
+
+
+def _cached_score(store, key, legacy_key=None):
+    score = store.cache_get(key) or 0
+    if not score and legacy_key is not None:
+        # legacy values are served as they are, not copied: the old key may belong to several profiles
+        score = store.cache_get(legacy_key) or 0
+    return float(score) if score else None
+
+
+def _legacy_key(phone, birthday, first_name, last_name):
+    return get_legacy_score_key(phone, birthday, first_name, last_name) if LEGACY_KEY_FALLBACK else None
+
+
+def _calculate_and_cache(store, key, phone, email, birthday, gender, first_name, last_name):
+    score = calculate_score(phone, email, birthday, gender, first_name, last_name)
+    # cache for 60 minutes; a score that could not be cached is still a valid answer
+    try:
+        store.cache_set(key, str(score), SCORE_TTL)
+    except Exception as e:
+        logging.warning("Cannot cache score %s: %s", key, e)
     return float(score)
 
 
+def _fill_score(store, key, *profile):
+    if score_lock is None:
+        return _calculate_and_cache(store, key, *profile)
+    return score_lock.run(store, key, lambda: _calculate_and_cache(store, key, *profile),
+                          lambda: _cached_score(store, key))
+
+
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, email, birthday, gender, first_name, last_name)
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss, run once for all concurrent callers
+    score = _cached_score(store, key, _legacy_key(phone, birthday, first_name, last_name))
+    if score is not None:
+        return score
+    return score_flight.do(key, _fill_score, store, key, phone, email, birthday, gender, first_name, last_name)
+
+
+def get_scores(store, profiles):
+    """ Scores for a list of profiles (dicts of get_score arguments) with one cache read and one cache write """
+    keys = [get_score_key(p.get("phone"), p.get("email"), p.get("birthday"), p.get("gender"), p.get("first_name"),
+                          p.get("last_name"))
+            for p in profiles]
+    cached = store.cache_get_many(keys)
+    if LEGACY_KEY_FALLBACK and not all(cached):
+        missing = [i for i, value in enumerate(cached) if not value]
+        legacy = store.cache_get_many([get_legacy_score_key(profiles[i].get("phone"), profiles[i].get("birthday"),
+                                                            profiles[i].get("first_name"),
+                                                            profiles[i].get("last_name"))
+                                       for i in missing])
+        for i, value in zip(missing, legacy):
+            cached[i] = value
+    scores, misses = [], {}
+    for key, value, profile in zip(keys, cached, profiles):
+        if value:
+            scores.append(float(value))
+            continue
+        score = calculate_score(profile.get("phone"), profile.get("email"), profile.get("birthday"),
+                                profile.get("gender"), profile.get("first_name"), profile.get("last_name"))
+        misses[key] = str(score)
+        scores.append(float(score))
+    if misses:
+        try:
+            store.cache_set_many(misses, SCORE_TTL)
+        except Exception as e:
+            logging.warning("Cannot cache %s scores: %s", len(misses), e)
+    return scores
+
+
 def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
-    return json.loads(r) if r else []
+    return interests.decode_many(store, [store.get(interests.keys(store, [cid])[0])])[0]
+
+
+def get_interests_bulk(store, cids):
+    values = store.get_many(interests.keys(store, cids))
+    return dict(zip(cids, interests.decode_many(store, values)))
+
+
+async def get_score_async(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, email, birthday, gender, first_name, last_name)
+    score = await store.cache_get(key) or 0
+    if not score and LEGACY_KEY_FALLBACK:
+        score = await store.cache_get(get_legacy_score_key(phone, birthday, first_name, last_name)) or 0
+    if score:
+        return float(score)
+    score = calculate_score(phone, email, birthday, gender, first_name, last_name)
+    try:
+        await store.cache_set(key, str(score), SCORE_TTL)
+    except Exception as e:
+        logging.warning("Cannot cache score %s: %s", key, e)
+    return float(score)
+
+
+async def get_interests_async(store, cid):
+    key = (await interests.keys_async(store, [cid]))[0]
+    return (await interests.decode_many_async(store, [await store.get(key)]))[0]
+
+
+async def get_interests_bulk_async(store, cids):
+    values = await store.get_many(await interests.keys_async(store, cids))
+    return dict(zip(cids, await interests.decode_many_async(store, values)))
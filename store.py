@@ -1,62 +1,479 @@
+import itertools
+import os
+import queue
 import redis
 import logging
-import time
+import socket
+import threading
+import uuid
 
-MAX_ATTEMPTS = 5
+from cache import TTLCache
+from local_store import LocalRedis
+from retry import RetryPolicy, CircuitBreaker, CircuitOpenError
+from metrics import STORE_SECONDS
+
+# errors meaning the storage is unreachable: retried and counted by the circuit breaker
+STORE_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.05
+RETRY_MAX_DELAY = 0.5
+# total time a single storage call may spend retrying
+RETRY_BUDGET = 1.0
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 5.0
+# keys per MGET or MSET; bigger lookups and writes are split into several sent in one pipeline
+GET_MANY_CHUNK = 1000
+# entries kept in the in-process score cache in front of Redis
+L1_CACHE_SIZE = 10000
+# absent keys remembered so that lookups of unknown clients do not go to Redis every time;
+# writes through this Store forget them at once, writes by other processes show up within NEGATIVE_TTL
+NEGATIVE_CACHE_SIZE = 50000
+NEGATIVE_TTL = 5.0
+# cache writes waiting for the write-behind flusher, and the most it sends in one pipeline
+WRITE_BEHIND_QUEUE_SIZE = 10000
+WRITE_BEHIND_BATCH = 500
+# the longest shutdown waits for queued cache writes
+WRITE_BEHIND_CLOSE_TIMEOUT = 5.0
+# connection settings; every one can be overridden with a REDIS_<NAME> environment variable
+STORE_DEFAULTS = {
+    "host": "localhost",
+    "port": 6379,
+    "db": 0,
+    "connect_timeout": 1.0,
+    "socket_timeout": 1.0,
+    "max_connections": 50,
+    "pool_timeout": 1.0,
+    "keepalive": True,
+    "health_check_interval": 30,
+}
+# "redis", or "local" for the embedded backend of local_store.py, in memory or shared through the file at path;
+# set with STORE_BACKEND and STORE_PATH
+BACKEND_DEFAULTS = {
+    "backend": "redis",
+    "path": "",
+}
+BACKENDS = ("local", "redis")
+
+
+def store_config_from_env(environ=None):
+    environ = os.environ if environ is None else environ
+    config = dict(STORE_DEFAULTS)
+    for name, default in STORE_DEFAULTS.items():
+        value = environ.get("REDIS_%s" % name.upper())
+        if value is None:
+            continue
+        if isinstance(default, bool):
+            config[name] = value.lower() in ("1", "true", "yes", "on")
+        else:
+            config[name] = type(default)(value)
+    for name in BACKEND_DEFAULTS:
+        config[name] = environ.get("STORE_%s" % name.upper(), BACKEND_DEFAULTS[name])
+    return config
+
+
+def add_store_options(parser):
+    """ Adds --store-* and --redis-* options to an OptionParser, defaults come from the environment """
+    config = store_config_from_env()
+    parser.add_option("--store-backend", action="store", choices=BACKENDS, default=config["backend"])
+    parser.add_option("--store-path", action="store", default=config["path"])
+    parser.add_option("--redis-host", action="store", default=config["host"])
+    parser.add_option("--redis-port", action="store", type=int, default=config["port"])
+    parser.add_option("--redis-db", action="store", type=int, default=config["db"])
+    parser.add_option("--redis-connect-timeout", action="store", type=float, default=config["connect_timeout"])
+    parser.add_option("--redis-socket-timeout", action="store", type=float, default=config["socket_timeout"])
+    parser.add_option("--redis-max-connections", action="store", type=int, default=config["max_connections"])
+    parser.add_option("--redis-pool-timeout", action="store", type=float, default=config["pool_timeout"])
+    parser.add_option("--redis-keepalive", action="store", type=int, default=int(config["keepalive"]))
+    parser.add_option("--redis-health-check-interval", action="store", type=int,
+                      default=config["health_check_interval"])
+
+
+def store_config_from_options(opts):
+    config = {name: getattr(opts, "redis_%s" % name) for name in STORE_DEFAULTS}
+    config["keepalive"] = bool(config["keepalive"])
+    config.update((name, getattr(opts, "store_%s" % name)) for name in BACKEND_DEFAULTS)
+    return config
+
+
+def keepalive_options():
+    """ Probe idle connections so dead peers are noticed instead of hanging forever """
+    options = {}
+    for name, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3)):
+        if hasattr(socket, name):
+            options[getattr(socket, name)] = value
+    return options
+
+
+class WriteBehind:
+    """ Cache writes queued in process and sent by a background thread in pipelined batches.
+
+    A write that does not fit in the queue is dropped rather than making the caller wait;
+    so is a batch Redis refuses. Both only cost a later cache miss.
+    """
+
+    def __init__(self, write_many, queue_size=WRITE_BEHIND_QUEUE_SIZE, batch_size=WRITE_BEHIND_BATCH):
+        self.write_many = write_many
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.queued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        # queued and dropped are counted by every handler thread, += on them is not atomic
+        self._counts_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def put(self, key, value, seconds_to_expire):
+        try:
+            self.queue.put_nowait((key, value, seconds_to_expire))
+        except queue.Full:
+            with self._counts_lock:
+                self.dropped += 1
+            return False
+        with self._counts_lock:
+            self.queued += 1
+        return True
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            items = [item for item in batch if item is not None]
+            if items:
+                try:
+                    self.write_many(items)
+                    self.flushed += len(items)
+                except Exception as e:
+                    self.failed += len(items)
+                    logging.warning("Cannot write %s cached values: %s", len(items), e)
+            for _ in batch:
+                self.queue.task_done()
+            if len(items) < len(batch):
+                return
+
+    def flush(self):
+        """ Waits until everything queued so far is written or given up """
+        self.queue.join()
+
+    def close(self, timeout=WRITE_BEHIND_CLOSE_TIMEOUT):
+        """ Flushes what is queued and stops the flusher; gives up after timeout seconds if Redis hangs """
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.warning("Write-behind flusher did not stop in %s s, %s cache writes are lost",
+                            timeout, self.queue.qsize())
+            return False
+        return True
+
+    def stats(self):
+        return {
+            "queue_size": self.queue.qsize(),
+            "queued": self.queued,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
 
 
 class Store:
-    def __init__(self):
-        self.client = redis.Redis()
+    def __init__(self, host=STORE_DEFAULTS["host"], port=STORE_DEFAULTS["port"], db=STORE_DEFAULTS["db"],
+                 connect_timeout=STORE_DEFAULTS["connect_timeout"], socket_timeout=STORE_DEFAULTS["socket_timeout"],
+                 max_connections=STORE_DEFAULTS["max_connections"], pool_timeout=STORE_DEFAULTS["pool_timeout"],
+                 keepalive=STORE_DEFAULTS["keepalive"],
+                 health_check_interval=STORE_DEFAULTS["health_check_interval"],
+                 l1_cache_size=L1_CACHE_SIZE, negative_cache_size=NEGATIVE_CACHE_SIZE, negative_ttl=NEGATIVE_TTL,
+                 write_behind=0, retry_policy=None, breaker=None, backend=BACKEND_DEFAULTS["backend"],
+                 path=BACKEND_DEFAULTS["path"]):
+        if backend == "local":
+            self.client = LocalRedis(path or None)
+        elif backend == "redis":
+            # a blocking pool never opens more than max_connections sockets,
+            # callers wait up to pool_timeout for a free one instead
+            pool = redis.BlockingConnectionPool(
+                host=host, port=port, db=db,
+                socket_connect_timeout=connect_timeout,
+                socket_timeout=socket_timeout,
+                socket_keepalive=keepalive,
+                socket_keepalive_options=keepalive_options() if keepalive else None,
+                health_check_interval=health_check_interval,
+                max_connections=max_connections,
+                timeout=pool_timeout,
+            )
+            self.client = redis.Redis(connection_pool=pool)
+        else:
+            raise ValueError("Unknown storage backend: %s" % backend)
+        self.l1 = TTLCache(maxsize=l1_cache_size)
+        self.negative = TTLCache(maxsize=negative_cache_size, ttl=negative_ttl)
+        # bumped on every write, so a read that raced with a write does not remember the key as absent
+        self._generations = itertools.count(1)
+        self._generation = 0
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                                                        max_delay=RETRY_MAX_DELAY, budget=RETRY_BUDGET,
+                                                        retry_on=STORE_ERRORS)
+        # while Redis is down the breaker answers at once and pings it in the background
+        self.breaker = breaker or CircuitBreaker(failure_threshold=BREAKER_THRESHOLD,
+                                                 reset_timeout=BREAKER_RESET_TIMEOUT,
+                                                 probe=lambda: self.client.ping(), failure_on=STORE_ERRORS)
+        # with a queue size given, cache writes are acknowledged at once and sent to Redis in the background
+        self.write_behind = WriteBehind(self._setex_many, write_behind) if write_behind else None
 
     def ping(self):
         return self.client.ping()
 
+    def _execute(self, operation, command, *args):
+        """ Runs a storage command with retries, failing fast while the circuit is open """
+        try:
+            with STORE_SECONDS.time(operation=operation):
+                return self.retry_policy.call(self.breaker.call, command, *args)
+        except CircuitOpenError as e:
+            raise redis.exceptions.ConnectionError("Storage is unavailable: %s" % e)
+        except STORE_ERRORS as e:
+            logging.info("Cannot connect to Redis: %s", e)
+            raise redis.exceptions.ConnectionError(str(e))
+
     def set(self, key, value):
-        n = 1
-        while n <= MAX_ATTEMPTS:
-            try:
-                return self.client.set(key, value)
-            except Exception as e:
-                logging.info("Cannot connect to Redis at %s attempt: %s ..." % (n, e))
-                n += 1
-                time.sleep(1)
-        raise redis.exceptions.ConnectionError
+        self.l1.delete(key)
+        self._forget_missing([key])
+        try:
+            return self._execute("set", self.client.set, key, value)
+        finally:
+            # a read that went to Redis before the write landed may have remembered the key meanwhile
+            self._forget_missing([key])
+
+    def _remember_missing(self, keys, generation):
+        if generation == self._generation:
+            for key in keys:
+                self.negative.set(key, True)
+
+    def _forget_missing(self, keys):
+        # next() on a count is atomic, unlike += shared by the handler threads
+        self._generation = next(self._generations)
+        for key in keys:
+            self.negative.delete(key)
 
     def get(self, key: str):
-        n = 1
-        while n <= MAX_ATTEMPTS:
-            try:
-                resp = self.client.get(key)
-            except Exception as e:
-                logging.info("Cannot connect to Redis at %s attempt: %s ..." % (n, e))
-                n += 1
-                time.sleep(1)
-            else:
-                if resp:
-                    return resp
-                return None
-        raise redis.exceptions.ConnectionError
+        if self.negative.get(key):
+            return None
+        generation = self._generation
+        value = self._execute("get", self.client.get, key) or None
+        if value is None:
+            self._remember_missing([key], generation)
+        return value
+
+    def get_many(self, keys):
+        """ Values for all keys (None for missing ones) in one round trip """
+        keys = list(keys)
+        lookup = [key for key in keys if not self.negative.get(key)]
+        if not lookup:
+            return [None] * len(keys)
+
+        def mget():
+            pipe = self.client.pipeline(transaction=False)
+            for i in range(0, len(lookup), GET_MANY_CHUNK):
+                pipe.mget(lookup[i:i + GET_MANY_CHUNK])
+            return pipe.execute()
+
+        generation = self._generation
+        chunks = self._execute("get_many", mget)
+        found = dict(zip(lookup, (value for chunk in chunks for value in chunk)))
+        self._remember_missing([key for key, value in found.items() if not value], generation)
+        return [found.get(key) or None for key in keys]
+
+    def set_many(self, mapping):
+        """ Sets every key of the mapping in one round trip, GET_MANY_CHUNK keys per MSET """
+        if not mapping:
+            return True
+        for key in mapping:
+            self.l1.delete(key)
+        self._forget_missing(mapping)
+        items = list(mapping.items())
+
+        def set_all():
+            pipe = self.client.pipeline(transaction=False)
+            for i in range(0, len(items), GET_MANY_CHUNK):
+                pipe.mset(dict(items[i:i + GET_MANY_CHUNK]))
+            return pipe.execute()
+
+        try:
+            return all(self._execute("set_many", set_all))
+        finally:
+            self._forget_missing(mapping)
+
+    def scan(self, match, count=GET_MANY_CHUNK):
+        """ Lists of keys matching the pattern, a batch per SCAN call """
+        cursor = 0
+        while True:
+            cursor, keys = self._execute("scan", self.client.scan, cursor, match, count)
+            if keys:
+                yield [key.decode("utf-8") if isinstance(key, bytes) else key for key in keys]
+            if not cursor:
+                break
 
     def delete(self, *keys):
-        n = 1
-        while n <= MAX_ATTEMPTS:
-            try:
-                return self.client.delete(*keys)
-            except Exception as e:
-                logging.info("Cannot connect to Redis at %s attempt: %s ..." % (n, e))
-                n += 1
-                time.sleep(1)
-        raise redis.exceptions.ConnectionError
+        for key in keys:
+            self.l1.delete(key)
+        self._forget_missing(keys)
+        try:
+            return self._execute("delete", self.client.delete, *keys)
+        finally:
+            self._forget_missing(keys)
 
     def cache_set(self, key: str, value, seconds_to_expire):
         """ Implemented as an example; it goes to the same key-value storage """
-        return self.client.setex(key, seconds_to_expire, value)
+        if self.write_behind is not None:
+            self._cache_locally(key, value, seconds_to_expire)
+            return self.write_behind.put(key, value, seconds_to_expire)
+        try:
+            with STORE_SECONDS.time(operation="cache_set"):
+                result = self.breaker.call(self.client.setex, key, seconds_to_expire, value)
+        except CircuitOpenError as e:
+            raise redis.exceptions.ConnectionError("Storage is unavailable: %s" % e)
+        self._cache_locally(key, value, seconds_to_expire)
+        return result
+
+    def _cache_locally(self, key, value, seconds_to_expire):
+        # keep the value the way Redis gives it back
+        self.l1.set(key, value if isinstance(value, bytes) else str(value).encode("utf-8"), seconds_to_expire)
 
     def cache_get(self, key: str):
         """ Implemented as an example; it goes to the same key-value storage """
+        value = self.l1.get(key)
+        if value is not None:
+            return value
+
+        def get_with_ttl():
+            pipe = self.client.pipeline(transaction=False)
+            pipe.get(key)
+            pipe.pttl(key)
+            return pipe.execute()
+
         # Emulate cache by trying to connect to Redis once
         try:
-            return self.client.get(key)
+            with STORE_SECONDS.time(operation="cache_get"):
+                value, ttl_ms = self.breaker.call(get_with_ttl)
         except:
             return None
+        if value is not None and ttl_ms > 0:
+            # the local copy expires together with the one in Redis
+            self.l1.set(key, value, ttl_ms / 1000.0)
+        return value
+
+    def cache_get_many(self, keys):
+        """ Cached values for all keys (None for misses), Redis is asked once for what is not held locally """
+        values = [self.l1.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if not missing:
+            return values
+
+        def get_with_ttl():
+            pipe = self.client.pipeline(transaction=False)
+            for i in missing:
+                pipe.get(keys[i])
+                pipe.pttl(keys[i])
+            return pipe.execute()
+
+        try:
+            with STORE_SECONDS.time(operation="cache_get_many"):
+                replies = self.breaker.call(get_with_ttl)
+        except:
+            return values
+        for n, i in enumerate(missing):
+            value, ttl_ms = replies[2 * n], replies[2 * n + 1]
+            if value is not None and ttl_ms > 0:
+                self.l1.set(keys[i], value, ttl_ms / 1000.0)
+            values[i] = value
+        return values
+
+    def cache_set_many(self, mapping, seconds_to_expire):
+        """ SETEX for every key of the mapping in one round trip """
+        if not mapping:
+            return True
+        if self.write_behind is not None:
+            queued = True
+            for key, value in mapping.items():
+                self._cache_locally(key, value, seconds_to_expire)
+                queued = self.write_behind.put(key, value, seconds_to_expire) and queued
+            return queued
+        result = self._setex_many([(key, value, seconds_to_expire) for key, value in mapping.items()])
+        for key, value in mapping.items():
+            self._cache_locally(key, value, seconds_to_expire)
+        return all(result)
+
+    def _setex_many(self, items):
+        """ SETEX for (key, value, seconds_to_expire) items in one pipeline """
+        def setex_all():
+            pipe = self.client.pipeline(transaction=False)
+            for key, value, seconds_to_expire in items:
+                pipe.setex(key, seconds_to_expire, value)
+            return pipe.execute()
+
+        try:
+            with STORE_SECONDS.time(operation="cache_set_many"):
+                return self.breaker.call(setex_all)
+        except CircuitOpenError as e:
+            raise redis.exceptions.ConnectionError("Storage is unavailable: %s" % e)
+
+    def lock(self, key, seconds_to_expire):
+        """ Takes a lock that expires by itself; returns its token, or None when somebody else holds it """
+        token = uuid.uuid4().hex
+        acquired = self._execute("lock", lambda: self.client.set(key, token, px=int(seconds_to_expire * 1000),
+                                                                 nx=True))
+        return token if acquired else None
+
+    def unlock(self, key, token):
+        """ Releases a lock taken with lock() unless it has expired and been taken by somebody else """
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != token.encode("utf-8"):
+                    return False
+                pipe.multi()
+                pipe.delete(key)
+                pipe.execute()
+                return True
+            except redis.exceptions.WatchError:
+                return False
+
+    def cache_stats(self):
+        return self.l1.stats()
+
+    def negative_cache_stats(self):
+        return self.negative.stats()
+
+    def write_behind_stats(self):
+        return self.write_behind.stats() if self.write_behind is not None else {}
+
+    def close(self):
+        if self.write_behind is not None:
+            self.write_behind.close()
+        if isinstance(self.client, LocalRedis):
+            self.client.close()
+
+    def breaker_stats(self):
+        return self.breaker.stats()
+
+    def pool_stats(self):
+        pool = getattr(self.client, "connection_pool", None)
+        if pool is None:
+            # the embedded backend has no connections
+            return {}
+        if isinstance(pool, redis.BlockingConnectionPool):
+            created = len(pool._connections)
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        else:
+            created = pool._created_connections
+            idle = len(pool._available_connections)
+        return {
+            "max_connections": pool.max_connections,
+            "created": created,
+            "idle": idle,
+            "in_use": created - idle,
+        }
@@ -19,6 +19,10 @@ def mock_get_interests(store, cid):
         return ['cars']
 
 
+def mock_get_interests_bulk(store, cids):
+    return {cid: mock_get_interests(store, cid) for cid in cids}
+
+
 class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {}
@@ -49,6 +53,32 @@ class TestSuite(unittest.TestCase):
         _, code, ctx = self.get_response(request)
         self.assertEqual(api.FORBIDDEN, code)
 
+    def test_auth_digests_are_memoized(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": {}}
+        self.set_valid_auth(request)
+        method_request = api.MethodRequest(**request)
+        self.assertTrue(api.check_auth(method_request))
+        with patch("api.hashlib") as hashlib_mock:
+            self.assertTrue(api.check_auth(method_request))
+        hashlib_mock.sha512.assert_not_called()
+
+    def test_admin_digest_is_computed_once_per_hour(self):
+        request = {"account": "horns&hoofs", "login": "admin", "method": "online_score", "arguments": {}}
+        self.set_valid_auth(request)
+        method_request = api.MethodRequest(**request)
+        self.assertTrue(api.check_auth(method_request))
+        with patch("api.datetime") as datetime_mock:
+            self.assertTrue(api.check_auth(method_request))
+        datetime_mock.datetime.now.assert_not_called()
+
+    def test_token_is_not_logged(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": {}}
+        self.set_valid_auth(request)
+        with patch("api.logging") as logging_mock:
+            self.assertTrue(api.check_auth(api.MethodRequest(**request)))
+            self.assertFalse(api.check_auth(api.MethodRequest(**dict(request, token="ключ"))))
+        logging_mock.info.assert_not_called()
+
     @cases([
         {"account": "horns&hoofs", "login": "h&f", "method": "online_score"},
         {"account": "horns&hoofs", "login": "h&f", "arguments": {}},
@@ -141,12 +171,12 @@ class TestSuite(unittest.TestCase):
         {"client_ids": ["1", "2"], "date": "20.07.2017"},
         {"client_ids": [1, 2], "date": "XXX"},
     ])
-    @patch('api.get_interests')
+    @patch('api.get_interests_bulk')
     def test_invalid_interests_request(self, arguments, mock):
         request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": arguments}
         self.set_valid_auth(request)
         # mock request to Redis server
-        mock.side_effect = mock_get_interests
+        mock.side_effect = mock_get_interests_bulk
         response, code, ctx = self.get_response(request)
         self.assertEqual(api.INVALID_REQUEST, code, arguments)
         self.assertTrue(len(response))
@@ -156,12 +186,12 @@ class TestSuite(unittest.TestCase):
         {"client_ids": [1, 2], "date": "19.07.2017"},
         {"client_ids": [0]},
     ])
-    @patch('api.get_interests')
+    @patch('api.get_interests_bulk')
     def test_ok_interests_request(self, arguments, mock):
         request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": arguments}
         self.set_valid_auth(request)
         # mock request to Redis server
-        mock.side_effect = mock_get_interests
+        mock.side_effect = mock_get_interests_bulk
         response, code, ctx = self.get_response(request)
         self.assertEqual(api.OK, code, arguments)
         self.assertEqual(len(arguments["client_ids"]), len(response))
@@ -169,6 +199,43 @@ class TestSuite(unittest.TestCase):
                         for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    def get_batch_response(self, items, login="h&f"):
+        request = {"account": "horns&hoofs", "login": login, "method": "online_score_batch",
+                   "arguments": {"items": items}}
+        self.set_valid_auth(request)
+        return self.get_response(request)
+
+    def test_ok_score_batch_request(self):
+        self.settings = Mock()
+        self.settings.cache_get_many.side_effect = lambda keys: [None] * len(keys)
+        items = [
+            {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+            {"phone": "89175002040"},
+            {"first_name": "a", "last_name": "b"},
+        ]
+        response, code, ctx = self.get_batch_response(items)
+        self.assertEqual(api.OK, code)
+        scores = response["scores"]
+        self.assertEqual(scores[0], {"score": 3.0})
+        self.assertEqual(scores[1]["code"], api.INVALID_REQUEST)
+        self.assertEqual(scores[2], {"score": 0.5})
+        # new keys first, then legacy keys of the misses
+        self.assertEqual(self.settings.cache_get_many.call_count, 2)
+        self.assertEqual(len(self.settings.cache_get_many.call_args[0][0]), 2)
+        self.assertEqual(self.settings.cache_set_many.call_count, 1)
+        self.assertEqual(len(self.settings.cache_set_many.call_args[0][0]), 2)
+        self.assertEqual((ctx["nitems"], ctx["nerrors"]), (3, 1))
+
+    def test_ok_score_batch_admin_request(self):
+        response, code, ctx = self.get_batch_response([{}, {"phone": "1"}], login=api.ADMIN_LOGIN)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response, {"scores": [{"score": 42}, {"score": 42}]})
+
+    def test_invalid_score_batch_request(self):
+        for items in ([], {"phone": "79175002040"}, ["phone"], [{}] * (api.BATCH_LIMIT + 1)):
+            response, code, ctx = self.get_batch_response(items)
+            self.assertEqual(api.INVALID_REQUEST, code, items)
+
 
 if __name__ == '__main___':
     unittest.main()
@@ -6,6 +6,7 @@ import json
 import fakeredis
 
 import api
+from scoring import get_score_key
 from store import Store
 from tests import cases
 
@@ -86,12 +87,8 @@ class ApiTest(unittest.TestCase):
         response, code, ctx = self.get_response(request)
         self.assertEqual(api.OK, code, arguments)
         # checking cache
-        key_parts = [
-            arguments.get("first_name") or "",
-            arguments.get("last_name") or "",
-            str(arguments.get("phone") or ""),
-        ]
-        key = "uid:" + hashlib.md5("".join(key_parts).encode("utf-8")).hexdigest()
+        key = get_score_key(phone=arguments.get("phone"), email=arguments.get("email"),
+                            first_name=arguments.get("first_name"), last_name=arguments.get("last_name"))
         resp = self.settings.cache_get(key)
         self.assertTrue(resp)
         self.assertTrue(float(resp.decode()) > 0)
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import json
+import unittest
+
+import redis
+
+import api
+import async_api
+import interests
+from async_store import AsyncStore
+from tests.resp_server import RespServer
+
+
+class AsyncApiTest(unittest.IsolatedAsyncioTestCase):
+    """ Runs the asyncio front end against an in-process Redis stand-in """
+
+    async def asyncSetUp(self):
+        self.redis_server = await RespServer().start()
+        self.store = AsyncStore(port=self.redis_server.port)
+        self.server = async_api.AsyncHTTPServer(self.store, port=0)
+        await self.server.start()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+        await self.store.close()
+        await self.redis_server.close()
+
+    def make_request(self, arguments, method="online_score"):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": method, "arguments": arguments}
+        msg = request["account"] + request["login"] + api.SALT
+        request["token"] = hashlib.sha512(msg.encode('utf-8')).hexdigest()
+        return request
+
+    async def post(self, requests, path="/method"):
+        reader, writer = await asyncio.open_connection("localhost", self.server.port)
+        results = []
+        try:
+            for request in requests:
+                body = json.dumps(request).encode()
+                writer.write(b"POST %s HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n%s"
+                             % (path.encode(), len(body), body))
+                await writer.drain()
+                status = int((await reader.readline()).split()[1])
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line == b"\r\n":
+                        break
+                    name, _, value = line.decode().partition(":")
+                    headers[name.lower()] = value.strip()
+                results.append((status, json.loads(await reader.readexactly(int(headers["content-length"])))))
+        finally:
+            writer.close()
+        return results
+
+    async def test_store_roundtrip(self):
+        self.assertTrue(await self.store.ping())
+        self.assertTrue(await self.store.set("key", "value"))
+        self.assertEqual(await self.store.get("key"), b"value")
+        self.assertEqual(await self.store.get("missing"), None)
+        self.assertTrue(await self.store.cache_set("cache_key", "1.5", 60))
+        self.assertEqual(await self.store.cache_get("cache_key"), b"1.5")
+        self.assertEqual(await self.store.delete("key", "cache_key"), 2)
+
+    async def test_absent_keys_are_remembered_until_written(self):
+        self.assertEqual(await self.store.get_many(["i:1", "i:2"]), [None, None])
+        self.redis_server.redis.set("i:1", "[]")
+        self.assertEqual(await self.store.get("i:1"), None)
+        await self.store.set("i:2", "[]")
+        self.assertEqual(await self.store.get_many(["i:1", "i:2"]), [None, b"[]"])
+        self.assertEqual(self.store.negative_cache_stats()["hits"], 2)
+
+    async def test_cache_get_when_storage_is_down(self):
+        store = AsyncStore(port=self.redis_server.port)
+        await self.redis_server.close()
+        self.assertEqual(await store.cache_get("key"), None)
+        with self.assertRaises(redis.exceptions.ConnectionError):
+            await store.cache_set("key", "1", 60)
+
+    async def test_pool_stats(self):
+        await asyncio.gather(*[self.store.get("key") for _ in range(10)])
+        stats = self.store.pool_stats()
+        self.assertEqual(stats["in_use"], 0)
+        self.assertEqual(stats["idle"], stats["created"])
+        self.assertLessEqual(stats["created"], 10)
+
+    async def test_pool_timeout(self):
+        store = AsyncStore(port=self.redis_server.port, max_connections=1, pool_timeout=0.01)
+        await store.client._slots.acquire()
+        with self.assertRaises(redis.exceptions.ConnectionError):
+            await store.client.get("key")
+        await store.close()
+
+    async def test_idle_connection_is_health_checked(self):
+        store = AsyncStore(port=self.redis_server.port, health_check_interval=1)
+        await store.set("key", "value")
+        reader, writer, last_used = store.client._idle[-1]
+        store.client._idle[-1] = (reader, writer, last_used - 5)
+        writer.close()
+        self.assertEqual(await store.get("key"), b"value")
+        self.assertEqual(store.pool_stats()["created"], 1)
+        await store.close()
+
+    async def test_ok_score_request(self):
+        request = self.make_request({"phone": "79175002040", "email": "stupnikov@otus.ru"})
+        [(status, body)] = await self.post([request])
+        self.assertEqual(status, api.OK)
+        self.assertEqual(body, {"response": {"score": 3.0}, "code": api.OK})
+
+    async def test_ok_interests_request(self):
+        self.redis_server.redis.set("i:1", json.dumps(["sport", "books"]))
+        request = self.make_request({"client_ids": [1, 2]}, method="clients_interests")
+        [(status, body)] = await self.post([request])
+        self.assertEqual(status, api.OK)
+        self.assertEqual(body["response"], {"1": ["sport", "books"], "2": []})
+
+    async def test_packed_interests_request(self):
+        interests.VOCABULARY.clear()
+        self.redis_server.redis.set(interests.VOCABULARY_KEY, json.dumps(["sport", "books"]))
+        self.redis_server.redis.set("i:1", interests.pack(["books", "sport"], {"sport": 0, "books": 1}))
+        self.redis_server.redis.set("i:2", json.dumps(["cars"]))
+        request = self.make_request({"client_ids": [1, 2]}, method="clients_interests")
+        [(status, body)] = await self.post([request])
+        self.assertEqual(body["response"], {"1": ["books", "sport"], "2": ["cars"]})
+
+    async def test_invalid_and_forbidden_requests_on_one_connection(self):
+        invalid = self.make_request({"phone": "89175002040"})
+        forbidden = dict(self.make_request({}), token="bad")
+        results = await self.post([invalid, forbidden])
+        self.assertEqual([status for status, _ in results], [api.INVALID_REQUEST, api.FORBIDDEN])
+
+    async def test_not_found(self):
+        [(status, body)] = await self.post([self.make_request({})], path="/unknown")
+        self.assertEqual(status, api.NOT_FOUND)
+
+    async def test_concurrent_connections(self):
+        request = self.make_request({"first_name": "a", "last_name": "b"})
+        results = await asyncio.gather(*[self.post([request]) for _ in range(50)])
+        self.assertTrue(all(status == api.OK for [(status, _)] in results))
+
+
+if __name__ == '__main__':
+    unittest.main()
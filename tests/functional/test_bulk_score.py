@@ -0,0 +1,80 @@
+import io
+import unittest
+import unittest.mock
+
+import fakeredis
+
+import bulk_score
+import codec
+from store import Store
+
+
+def fake_store():
+    store = Store()
+    store.client = fakeredis.FakeStrictRedis()
+    return store
+
+
+LINES = [
+    b'{"phone": "79175002040", "email": "stupnikov@otus.ru"}\n',
+    b'\n',
+    b'not json\n',
+    b'{"phone": "1"}\n',
+    b'[1]\n',
+    b'{"first_name": "a", "last_name": "b"}\n',
+]
+
+
+class BulkScoreTestCase(unittest.TestCase):
+    def score(self, lines, **kwargs):
+        out = io.BytesIO()
+        count = bulk_score.run(iter(lines), out, fake_store, **kwargs)
+        return count, [codec.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_lines_are_scored_in_order(self):
+        count, results = self.score(LINES, workers=0, chunk_size=2)
+        self.assertEqual(count, 5)
+        self.assertEqual(results, [
+            {"line": 1, "score": 3.0},
+            {"line": 3, "error": "Invalid JSON", "code": 422},
+            {"line": 4, "error": "Invalid phone number given: 1", "code": 422},
+            {"line": 5, "error": "Item should be an object", "code": 422},
+            {"line": 6, "score": 0.5},
+        ])
+
+    def test_process_pool_keeps_input_order(self):
+        lines = LINES * 20
+        _, expected = self.score(lines, workers=0, chunk_size=7)
+        count, results = self.score(lines, workers=2, chunk_size=7)
+        self.assertEqual(count, 100)
+        self.assertEqual(results, expected)
+
+    def test_chunk_reads_and_writes_the_cache_in_batches(self):
+        store = fake_store()
+        chunk = [(n, line) for n, line in enumerate(LINES, 1) if line.strip()]
+        with unittest.mock.patch.object(store, "cache_get_many", wraps=store.cache_get_many) as get_many, \
+                unittest.mock.patch.object(store, "cache_set_many", wraps=store.cache_set_many) as set_many:
+            bulk_score.score_chunk(chunk, store)
+        # the profiles are new, so the legacy keys are read with a second batched lookup
+        self.assertEqual(get_many.call_count, 2)
+        set_many.assert_called_once()
+
+        with unittest.mock.patch.object(store, "cache_get_many", wraps=store.cache_get_many) as get_many, \
+                unittest.mock.patch.object(store, "cache_set_many", wraps=store.cache_set_many) as set_many:
+            bulk_score.score_chunk(chunk, store)
+        get_many.assert_called_once()
+        set_many.assert_not_called()
+
+    def test_progress_is_reported_per_interval(self):
+        now = [0]
+        progress = bulk_score.Progress(interval=10, timer=lambda: now[0])
+        with unittest.mock.patch.object(progress, "report") as report:
+            progress.add(5)
+            now[0] = 11
+            progress.add(5)
+        report.assert_called_once()
+        self.assertEqual(progress.lines, 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
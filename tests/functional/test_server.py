@@ -0,0 +1,380 @@
+import hashlib
+import http.client
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import fakeredis
+
+import api
+from admission import AdmissionControl
+from store import Store
+
+
+class ServerTest(unittest.TestCase):
+    """ Runs the HTTP server in a background thread on top of an in-memory storage """
+    threads = 4
+
+    def setUp(self):
+        store = Store()
+        store.client = fakeredis.FakeStrictRedis()
+
+        class Handler(api.MainHTTPHandler):
+            timeout = 1
+            max_requests = 3
+
+            def log_message(self, *args):
+                pass
+        Handler.store = store
+
+        self.store = store
+        self.server = api.ThreadPoolHTTPServer(("localhost", 0), Handler, threads=self.threads)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def make_request(self, arguments, method="online_score"):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": method, "arguments": arguments}
+        msg = request["account"] + request["login"] + api.SALT
+        request["token"] = hashlib.sha512(msg.encode('utf-8')).hexdigest()
+        return request
+
+    def post(self, request, path="/method"):
+        conn = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            conn.request("POST", path, body=json.dumps(request), headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            return resp.status, json.loads(resp.read())
+        finally:
+            conn.close()
+
+    def assert_idle(self, admission):
+        """ Slots are given back right after the last byte is written, so the client may read first """
+        deadline = time.monotonic() + 5
+        while admission.stats()["in_flight"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(admission.stats()["in_flight"], 0)
+
+    def test_ok_score_request(self):
+        status, body = self.post(self.make_request({"first_name": "a", "last_name": "b"}))
+        self.assertEqual(status, api.OK)
+        self.assertEqual(body["code"], api.OK)
+        self.assertEqual(body["response"]["score"], 0.5)
+
+    def test_not_found(self):
+        status, body = self.post(self.make_request({}), path="/unknown")
+        self.assertEqual(status, api.NOT_FOUND)
+        self.assertEqual(body["error"], api.ERRORS[api.NOT_FOUND])
+
+    def test_keep_alive(self):
+        conn = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        body = json.dumps(self.make_request({"first_name": "a", "last_name": "b"}))
+        try:
+            sockets = set()
+            for _ in range(2):
+                conn.request("POST", "/method", body=body)
+                resp = conn.getresponse()
+                self.assertEqual(resp.status, api.OK)
+                self.assertEqual(int(resp.getheader("Content-Length")), len(resp.read()))
+                self.assertFalse(resp.will_close)
+                sockets.add(id(conn.sock))
+            self.assertEqual(len(sockets), 1)
+            # the last request allowed on a connection closes it
+            conn.request("POST", "/method", body=body)
+            resp = conn.getresponse()
+            resp.read()
+            self.assertEqual(resp.getheader("Connection"), "close")
+        finally:
+            conn.close()
+
+    def test_idle_connection_is_closed_quietly(self):
+        with patch.object(self.server.RequestHandlerClass, "log_message", api.MainHTTPHandler.log_message), \
+                patch.object(api.logging, "warning") as warning:
+            with socket.create_connection(("localhost", self.port), timeout=5) as sock:
+                sock.sendall(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                sock.recv(65536)
+                # the server closes the connection once it has been idle for the handler timeout
+                while sock.recv(65536):
+                    pass
+            self.assertFalse(warning.called)
+            with socket.create_connection(("localhost", self.port), timeout=5) as sock:
+                sock.sendall(b"GARBAGE\r\n\r\n")
+                while sock.recv(65536):
+                    pass
+            self.assertTrue(warning.called)
+
+    def test_error_response_has_content_length(self):
+        conn = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            conn.request("POST", "/method", body=b"{not json")
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, api.BAD_REQUEST)
+            self.assertEqual(json.loads(resp.read())["code"], api.BAD_REQUEST)
+            self.assertFalse(resp.will_close)
+            conn.request("POST", "/unknown", body=b"{}")
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, api.NOT_FOUND)
+            self.assertEqual(int(resp.getheader("Content-Length")), len(resp.read()))
+        finally:
+            conn.close()
+
+    def test_pipelined_requests(self):
+        body = json.dumps(self.make_request({"first_name": "a", "last_name": "b"})).encode()
+        request = b"POST /method HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+        with socket.create_connection(("localhost", self.port), timeout=5) as sock:
+            sock.sendall(request * 3)
+            data = b""
+            while data.count(b'"code":200}') < 3:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        self.assertEqual(data.count(b"HTTP/1.1 200"), 3)
+
+    def test_missing_content_length_closes_connection(self):
+        with socket.create_connection(("localhost", self.port), timeout=5) as sock:
+            sock.sendall(b"POST /method HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            data = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        self.assertTrue(data.startswith(b"HTTP/1.1 400"))
+        self.assertIn(b"Connection: close", data)
+
+    def test_metrics(self):
+        conn = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            # one connection, so the metrics of a request are recorded before the next one is read
+            for request in (self.make_request({"first_name": "a", "last_name": "b"}),
+                            self.make_request({"client_ids": [1, 2]}, method="clients_interests")):
+                conn.request("POST", "/method", body=json.dumps(request))
+                conn.getresponse().read()
+            conn.request("GET", "/metrics")
+            resp = conn.getresponse()
+            body = resp.read().decode()
+        finally:
+            conn.close()
+        self.assertEqual(resp.status, api.OK)
+        self.assertTrue(resp.getheader("Content-Type").startswith("text/plain"))
+        self.assertIn('scoring_request_duration_seconds_count{method="online_score",code="200"}', body)
+        self.assertIn('scoring_request_duration_seconds_count{method="clients_interests",code="200"}', body)
+        for stage in ("read", "decode", "validation", "auth", "handler", "write"):
+            self.assertIn('scoring_stage_duration_seconds_count{stage="%s",method="online_score"}' % stage, body)
+        self.assertIn('scoring_store_duration_seconds_count{operation="get_many"}', body)
+        self.assertIn('scoring_store{stat="cache_hits"}', body)
+
+    def test_unknown_get_route(self):
+        conn = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            conn.request("GET", "/unknown")
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, api.NOT_FOUND)
+            self.assertEqual(json.loads(resp.read())["code"], api.NOT_FOUND)
+        finally:
+            conn.close()
+
+    @patch.object(api, "STREAM_CHUNK", 3)
+    @patch.object(api, "STREAM_THRESHOLD", 5)
+    def test_streamed_interests(self):
+        for cid in range(1, 11, 2):
+            self.store.set("i:%s" % cid, json.dumps(["sport", str(cid)]))
+        client_ids = [3, 1, 2, 3] + list(range(4, 11))
+        expected = {str(cid): ["sport", str(cid)] if cid % 2 else [] for cid in client_ids}
+        conn = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            for _ in range(2):
+                with patch.object(api, "get_interests_bulk", wraps=api.get_interests_bulk) as bulk:
+                    conn.request("POST", "/method", body=json.dumps(self.make_request({"client_ids": client_ids},
+                                                                                      method="clients_interests")))
+                    resp = conn.getresponse()
+                    data = resp.read()
+                # 10 distinct clients, 3 per storage round trip
+                self.assertEqual(bulk.call_count, 4)
+                self.assertEqual(resp.getheader("Transfer-Encoding"), "chunked")
+                self.assertEqual(json.loads(data), {"response": expected, "code": api.OK})
+                self.assertEqual(list(json.loads(data)["response"]), list(expected))
+                self.assertFalse(resp.will_close)
+        finally:
+            conn.close()
+
+    @patch.object(api, "STREAM_THRESHOLD", 1)
+    def test_streamed_interests_to_http_1_0_client(self):
+        body = json.dumps(self.make_request({"client_ids": [1, 2]}, method="clients_interests")).encode()
+        with socket.create_connection(("localhost", self.port), timeout=5) as sock:
+            sock.sendall(b"POST /method HTTP/1.0\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+            data = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        head, _, body = data.partition(b"\r\n\r\n")
+        self.assertNotIn(b"chunked", head)
+        self.assertEqual(json.loads(body), {"response": {"1": [], "2": []}, "code": api.OK})
+
+    @patch.object(api, "STREAM_THRESHOLD", 1)
+    def test_streamed_interests_storage_failure(self):
+        server = fakeredis.FakeServer()
+        server.connected = False
+        self.server.RequestHandlerClass.store.client = fakeredis.FakeStrictRedis(server=server)
+        status, body = self.post(self.make_request({"client_ids": [1, 2]}, method="clients_interests"))
+        self.assertEqual(status, api.INTERNAL_ERROR)
+
+    def test_busy_server_answers_503(self):
+        self.server.RequestHandlerClass.admission = AdmissionControl(4, reserved=4)
+        light = self.make_request({"first_name": "a", "last_name": "b"})
+        heavy = self.make_request({"client_ids": [1, 2]}, method="clients_interests")
+        conn = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            conn.request("POST", "/method", body=json.dumps(heavy))
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, api.SERVICE_UNAVAILABLE)
+            self.assertEqual(resp.getheader("Retry-After"), str(api.RETRY_AFTER))
+            self.assertEqual(json.loads(resp.read())["code"], api.SERVICE_UNAVAILABLE)
+            # the connection stays usable, and light requests still get through
+            conn.request("POST", "/method", body=json.dumps(light))
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, api.OK)
+            resp.read()
+        finally:
+            conn.close()
+        self.assert_idle(self.server.RequestHandlerClass.admission)
+
+    @patch.object(api, "STREAM_CHUNK", 3)
+    @patch.object(api, "STREAM_THRESHOLD", 5)
+    def test_streamed_response_holds_admission_until_written(self):
+        admission = self.server.RequestHandlerClass.admission = AdmissionControl(4, reserved=0, max_heavy_cost=5)
+        streaming, release = threading.Event(), threading.Event()
+        get_interests_bulk = api.get_interests_bulk
+
+        def slow_get_interests_bulk(store, cids):
+            if cids[0] != 1:
+                # a later chunk of the stream, read while the response is being written
+                streaming.set()
+                release.wait(5)
+            return get_interests_bulk(store, cids)
+
+        conn = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            with patch.object(api, "get_interests_bulk", slow_get_interests_bulk):
+                conn.request("POST", "/method", body=json.dumps(self.make_request({"client_ids": list(range(1, 11))},
+                                                                                  method="clients_interests")))
+                self.assertTrue(streaming.wait(5))
+                self.assertEqual(admission.stats()["in_flight"], 1)
+                status, _ = self.post(self.make_request({"client_ids": [20, 21]}, method="clients_interests"))
+                self.assertEqual(status, api.SERVICE_UNAVAILABLE)
+                release.set()
+                resp = conn.getresponse()
+                self.assertEqual(len(json.loads(resp.read())["response"]), 10)
+        finally:
+            release.set()
+            conn.close()
+        self.assert_idle(admission)
+
+    def test_connections_beyond_threads_and_queue_are_rejected(self):
+        self.server.max_pending = 0
+        busy = [socket.create_connection(("localhost", self.port), timeout=5) for _ in range(self.threads)]
+        try:
+            # keep-alive connections hold every thread
+            for sock in busy:
+                sock.sendall(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                sock.recv(65536)
+            body = json.dumps(self.make_request({"first_name": "a", "last_name": "b"})).encode()
+            with socket.create_connection(("localhost", self.port), timeout=5) as sock:
+                sock.sendall(b"POST /method HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+                data = b""
+                while True:
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        break
+                    data += chunk
+        finally:
+            for sock in busy:
+                sock.close()
+        head, _, body = data.partition(b"\r\n\r\n")
+        self.assertTrue(head.startswith(b"HTTP/1.1 503"))
+        self.assertIn(b"Retry-After: 1", head)
+        self.assertEqual(json.loads(body)["code"], api.SERVICE_UNAVAILABLE)
+
+    def test_request_cost(self):
+        self.assertEqual(api.request_cost(self.make_request({"client_ids": [1, 2, 3]}, method="clients_interests")), 3)
+        self.assertEqual(api.request_cost(self.make_request({"items": [{}, {}]}, method="online_score_batch")), 2)
+        self.assertEqual(api.request_cost(self.make_request({"phone": "79175002040"})), 0)
+        self.assertEqual(api.request_cost({"arguments": "junk"}), 0)
+
+    def test_concurrent_requests(self):
+        request = self.make_request({"phone": "79175002040", "email": "stupnikov@otus.ru"})
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda _: self.post(request), range(32)))
+        self.assertTrue(all(status == api.OK for status, _ in results))
+        self.assertTrue(all(body["response"]["score"] == 3.0 for _, body in results))
+
+
+class WorkersTest(unittest.TestCase):
+    """ Runs the pre-fork server in a separate process on the embedded storage """
+
+    def free_port(self):
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            return sock.getsockname()[1]
+
+    def test_reuse_port_lets_servers_share_a_port(self):
+        first = api.ThreadPoolHTTPServer(("localhost", 0), api.MainHTTPHandler, threads=1, reuse_port=True)
+        try:
+            second = api.ThreadPoolHTTPServer(("localhost", first.server_address[1]), api.MainHTTPHandler,
+                                              threads=1, reuse_port=True)
+            second.server_close()
+        finally:
+            first.server_close()
+
+    def test_sigterm_stops_master_and_workers(self):
+        port = self.free_port()
+        script = ("import logging, api; logging.basicConfig(level=logging.INFO); "
+                  "api.serve_workers(%d, 2, threads=2, store_config={'backend': 'local'})" % port)
+        master = subprocess.Popen([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(api.__file__)),
+                                  stderr=subprocess.PIPE)
+        try:
+            deadline = time.monotonic() + 10
+            while True:
+                try:
+                    socket.create_connection(("localhost", port), timeout=1).close()
+                    break
+                except OSError:
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.05)
+            master.send_signal(signal.SIGTERM)
+            # the workers hold stderr as well, so it is closed only once they are gone too
+            _, err = master.communicate(timeout=10)
+        finally:
+            master.kill()
+            master.wait()
+        self.assertEqual(master.returncode, 0)
+        err = err.decode("utf-8")
+        workers = [int(pid) for pid in re.search(r"Started 2 workers: \[(.*)\]", err).group(1).split(",")]
+        for pid in workers:
+            # each worker went through the close path that flushes the cache writes
+            self.assertIn("Server at %d stopped (pid %d)" % (port, pid), err)
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+        with self.assertRaises(OSError):
+            socket.create_connection(("localhost", port), timeout=1).close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import fakeredis
+
+import interests
+import ingest_interests
+from ingest_interests import Checkpoint, load, drop_namespace, source_identity
+from scoring import get_interests_bulk
+from store import Store
+
+JSONL = b"".join(json.dumps({"cid": cid, "interests": names}).encode() + b"\n" for cid, names in [
+    (1, ["sport", "books"]), (2, ["cars"]), (3, []), (4, ["music", "sport"]), (5, ["travel"]),
+])
+CSV = b"cid,interests\n1,sport,books\n2,cars\n3\n4,music,sport\n5,travel\n"
+EXPECTED = {1: ["sport", "books"], 2: ["cars"], 3: [], 4: ["music", "sport"], 5: ["travel"]}
+
+
+class IngestInterestsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store = Store()
+        self.store.client = fakeredis.FakeStrictRedis()
+        interests.VOCABULARY.clear()
+        interests.NAMESPACE.clear()
+        self.addCleanup(interests.NAMESPACE.clear)
+        self.checkpoint_path = os.path.join(tempfile.mkdtemp(), "dump.checkpoint")
+
+    def read_all(self):
+        interests.NAMESPACE.clear()
+        return get_interests_bulk(self.store, list(EXPECTED))
+
+    def test_jsonl_and_csv_loads_are_the_same(self):
+        for fmt, dump in (("jsonl", JSONL), ("csv", CSV)):
+            self.store.client.flushall()
+            stats = load(self.store, io.BytesIO(dump), fmt, batch_size=2, parallel=2)
+            self.assertEqual(stats["written"], 5)
+            self.assertEqual(self.store.get("i:1"), b'["sport","books"]')
+            self.assertEqual(self.read_all(), EXPECTED)
+
+    def test_packed_load(self):
+        load(self.store, io.BytesIO(JSONL), "jsonl", batch_size=2, pack=True)
+        self.assertTrue(interests.is_packed(self.store.get("i:1")))
+        self.assertEqual(self.read_all(), EXPECTED)
+
+    def test_writes_are_pipelined_per_chunk(self):
+        with patch.object(self.store, "set_many", wraps=self.store.set_many) as set_many:
+            load(self.store, io.BytesIO(JSONL), "jsonl", batch_size=2, parallel=1)
+        self.assertEqual([len(call.args[0]) for call in set_many.call_args_list], [2, 2, 1])
+
+    def test_failed_load_is_resumed_from_the_checkpoint(self):
+        set_many = self.store.set_many
+        calls = []
+
+        def fail_third(mapping):
+            calls.append(list(mapping))
+            if len(calls) == 3:
+                raise ConnectionError("storage is down")
+            return set_many(mapping)
+
+        with patch.object(self.store, "set_many", side_effect=fail_third):
+            with self.assertRaises(ConnectionError):
+                load(self.store, io.BytesIO(JSONL), "jsonl", swap=True, namespace="new", batch_size=2, parallel=1,
+                     checkpoint=Checkpoint(self.checkpoint_path))
+        checkpoint = Checkpoint(self.checkpoint_path)
+        self.assertEqual((checkpoint.done, checkpoint.namespace), (4, "new"))
+        # readers have not been switched to the partial load
+        self.assertIsNone(self.store.get(interests.NAMESPACE_KEY))
+
+        stats = load(self.store, io.BytesIO(JSONL), "jsonl", swap=True, namespace="other", batch_size=2,
+                     checkpoint=checkpoint)
+        self.assertEqual((stats["skipped"], stats["written"], stats["namespace"]), (4, 1, "new"))
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+        self.assertEqual(self.read_all(), EXPECTED)
+
+    def test_swap_switches_readers_and_drops_previous_keys(self):
+        self.store.set("i:1", json.dumps(["old"]))
+        self.assertEqual(self.read_all()[1], ["old"])
+        with patch.object(ingest_interests.time, "sleep") as sleep:
+            stats = load(self.store, io.BytesIO(JSONL), "jsonl", swap=True, namespace="n1", drop_previous=True)
+        # readers still on the old namespace have switched by the time its keys are gone
+        self.assertGreater(sleep.call_args.args[0], interests.NAMESPACE_TTL)
+        self.assertEqual((stats["previous"], stats["dropped"]), (None, 1))
+        self.assertIsNone(self.store.get("i:1"))
+        self.assertEqual(self.read_all(), EXPECTED)
+
+        load(self.store, io.BytesIO(b'{"cid": 1, "interests": ["new"]}\n'), "jsonl", swap=True, namespace="n2")
+        self.assertEqual(self.read_all()[1], ["new"])
+        self.assertEqual(drop_namespace(self.store, "n1"), 5)
+        self.assertEqual(drop_namespace(self.store, "n2"), 1)
+
+    def test_plain_load_after_a_swap_reaches_readers(self):
+        load(self.store, io.BytesIO(b'{"cid": 1, "interests": ["a"]}\n'), "jsonl", swap=True)
+        stats = load(self.store, io.BytesIO(b'{"cid": 1, "interests": ["b"]}\n'), "jsonl")
+        self.assertIsNotNone(stats["namespace"])
+        self.assertEqual(self.read_all()[1], ["b"])
+
+    def test_checkpoint_of_another_dump_is_ignored(self):
+        dump = os.path.join(os.path.dirname(self.checkpoint_path), "dump.jsonl")
+        with open(dump, "wb") as f:
+            f.write(JSONL)
+        Checkpoint(self.checkpoint_path, source_identity(dump)).save(4, None)
+        self.assertEqual(Checkpoint(self.checkpoint_path, source_identity(dump)).done, 4)
+        with open(dump, "ab") as f:
+            f.write(b'{"cid": 6, "interests": []}\n')
+        with self.assertLogs(level="WARNING"):
+            checkpoint = Checkpoint(self.checkpoint_path, source_identity(dump))
+        self.assertEqual(checkpoint.done, 0)
+        with open(dump, "rb") as f:
+            stats = load(self.store, f, "jsonl", checkpoint=checkpoint)
+        self.assertEqual((stats["skipped"], stats["written"]), (0, 6))
+
+
+if __name__ == "__main__":
+    unittest.main()
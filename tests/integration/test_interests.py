@@ -0,0 +1,90 @@
+import json
+import unittest
+
+import fakeredis
+
+import interests
+from migrate_interests import migrate
+from scoring import get_interests, get_interests_bulk
+from store import Store
+
+
+class InterestsFormatTestCase(unittest.TestCase):
+    """ Both storage formats of i:<cid> against an in-memory fakeredis storage """
+    def setUp(self):
+        self.store = Store()
+        self.store.client = fakeredis.FakeStrictRedis()
+        interests.VOCABULARY.clear()
+        self.store.set("i:1", json.dumps(["sport", "books"]))
+        self.store.set("i:2", json.dumps(["books", "cars", "sport"]))
+        self.store.set("i:3", json.dumps([]))
+        self.expected = {1: ["sport", "books"], 2: ["books", "cars", "sport"], 3: [], 4: []}
+
+    def test_pack_and_decode(self):
+        ids = {"sport": 0, "books": 1}
+        value = interests.pack(["books", "sport", "books"], ids)
+        self.assertEqual(value, b"\x01\x01\x00\x00\x00\x01\x00")
+        self.assertTrue(interests.is_packed(value))
+        self.assertEqual(interests.decode(value, ["sport", "books"]), ["books", "sport", "books"])
+        self.assertEqual(interests.decode(b'["cars"]'), ["cars"])
+        self.assertEqual(interests.decode(None), [])
+
+    def test_migrate_packs_values_and_reads_stay_the_same(self):
+        stats = migrate(self.store, batch_size=2)
+        self.assertEqual(stats["scanned"], 3)
+        self.assertEqual(stats["rewritten"], 3)
+        self.assertLess(stats["bytes_after"], stats["bytes_before"])
+        self.assertEqual(json.loads(self.store.get(interests.VOCABULARY_KEY)), ["sport", "books", "cars"])
+        self.assertEqual(self.store.get("i:2"), b"\x01\x01\x00\x02\x00\x00\x00")
+        interests.VOCABULARY.clear()
+        self.assertEqual(get_interests_bulk(self.store, [1, 2, 3, 4]), self.expected)
+        self.assertEqual(get_interests(self.store, 2), self.expected[2])
+        # a second run has nothing to do
+        self.assertEqual(migrate(self.store)["rewritten"], 0)
+
+    def test_mixed_formats_and_vocabulary_is_loaded_once(self):
+        migrate(self.store)
+        self.store.set("i:4", json.dumps(["music"]))
+        interests.VOCABULARY.clear()
+        loads = interests.VOCABULARY.loads
+        for _ in range(3):
+            result = get_interests_bulk(self.store, [1, 2, 4])
+        self.assertEqual(result, {1: ["sport", "books"], 2: ["books", "cars", "sport"], 4: ["music"]})
+        self.assertEqual(interests.VOCABULARY.loads, loads + 1)
+
+    def test_vocabulary_is_reloaded_for_unknown_ids(self):
+        migrate(self.store)
+        self.assertEqual(get_interests(self.store, 1), ["sport", "books"])
+        self.store.set("i:5", json.dumps(["music"]))
+        migrate(self.store)
+        interests.VOCABULARY.names = interests.VOCABULARY.names[:3]
+        self.assertEqual(get_interests(self.store, 5), ["music"])
+
+    def test_decoded_values_are_cached_until_vocabulary_is_replaced(self):
+        migrate(self.store)
+        first = get_interests(self.store, 1)
+        first.append("changed")
+        self.assertEqual(get_interests(self.store, 1), ["sport", "books"])
+        self.assertEqual(len(interests.VOCABULARY.decoded), 1)
+        interests.VOCABULARY.update(json.dumps(["sport", "books", "cars", "music"]))
+        self.assertEqual(len(interests.VOCABULARY.decoded), 1)
+        interests.VOCABULARY.update(json.dumps(["books", "sport"]))
+        self.assertEqual(interests.VOCABULARY.decoded, {})
+
+    def test_migrate_unpack_restores_json(self):
+        before = {key: self.store.get(key) for key in ("i:1", "i:2", "i:3")}
+        migrate(self.store)
+        migrate(self.store, pack=False)
+        self.assertEqual({key: json.loads(self.store.get(key)) for key in before},
+                         {key: json.loads(value) for key, value in before.items()})
+
+    def test_dry_run_writes_nothing(self):
+        stats = migrate(self.store, dry_run=True)
+        self.assertEqual(stats["rewritten"], 3)
+        self.assertFalse(interests.is_packed(self.store.get("i:1")))
+        self.assertIsNone(self.store.get(interests.VOCABULARY_KEY))
+        self.assertIsNone(self.store.get("lock:" + interests.VOCABULARY_KEY))
+
+
+if __name__ == '__main__':
+    unittest.main()
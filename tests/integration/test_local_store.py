@@ -0,0 +1,123 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import local_store
+from local_store import LocalRedis
+from async_store import AsyncStore
+from scoring import get_score, get_score_async, get_score_key, get_interests_bulk
+from store import Store
+
+
+class LocalStoreTestCase(unittest.TestCase):
+    """ Store on the embedded backend, kept in memory only """
+    def setUp(self):
+        self.store = Store(backend="local")
+
+    def test_get_set_delete(self):
+        self.assertIsNone(self.store.get("i:1"))
+        self.store.set("i:1", '["books"]')
+        self.assertEqual(self.store.get("i:1"), b'["books"]')
+        self.store.set_many({"i:2": "[]", "i:3": 3})
+        self.assertEqual(self.store.get_many(["i:1", "i:2", "i:3", "i:4"]), [b'["books"]', b"[]", b"3", None])
+        self.assertEqual(self.store.delete("i:1", "i:4"), 1)
+        self.assertIsNone(self.store.get("i:1"))
+
+    def test_cache_expires(self):
+        self.store.cache_set("uid:1", 2.5, 60)
+        self.assertEqual(self.store.client.get("uid:1"), b"2.5")
+        self.assertLessEqual(self.store.client.pttl("uid:1"), 60000)
+        self.assertEqual(self.store.client.pttl("uid:2"), -2)
+        with patch.object(local_store, "now_ms", return_value=local_store.now_ms() + 61000):
+            self.assertIsNone(self.store.client.get("uid:1"))
+            self.assertEqual(self.store.client.data, {})
+
+    def test_scoring_and_interests(self):
+        self.assertEqual(get_score(self.store, "79175002040", "stupnikov@otus.ru"), 3.0)
+        self.assertEqual(self.store.client.get(get_score_key("79175002040", "stupnikov@otus.ru")), b"3.0")
+        self.store.set("i:1", '["sport"]')
+        self.assertEqual(get_interests_bulk(self.store, [1, 2]), {1: ["sport"], 2: []})
+
+    def test_lock(self):
+        token = self.store.lock("lock:a", 10)
+        self.assertIsNotNone(token)
+        self.assertIsNone(self.store.lock("lock:a", 10))
+        self.assertFalse(self.store.unlock("lock:a", "other"))
+        self.assertTrue(self.store.unlock("lock:a", token))
+        self.assertIsNotNone(self.store.lock("lock:a", 10))
+
+    def test_scan(self):
+        self.store.set_many({"i:%s" % i: "[]" for i in range(25)})
+        self.store.set("interests:vocabulary", "[]")
+        batches = list(self.store.scan("i:*", 10))
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual(sorted(key for batch in batches for key in batch), sorted("i:%s" % i for i in range(25)))
+
+    def test_async_store(self):
+        async def score():
+            store = AsyncStore(backend="local")
+            result = await get_score_async(store, "79175002040", "stupnikov@otus.ru")
+            cached = await store.cache_get(get_score_key("79175002040", "stupnikov@otus.ru"))
+            await store.close()
+            return result, cached
+
+        self.assertEqual(asyncio.run(score()), (3.0, b"3.0"))
+
+
+class SharedLocalStoreTestCase(unittest.TestCase):
+    """ Several stores, as in several worker processes, on one log file """
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "store.log")
+
+    def test_writes_are_seen_by_other_stores_and_survive_restarts(self):
+        first, second = LocalRedis(self.path), LocalRedis(self.path)
+        first.set("a", "1")
+        first.setex("b", 60, "2")
+        self.assertEqual(second.mget(["a", "b"]), [b"1", b"2"])
+        second.delete("a")
+        self.assertIsNone(first.get("a"))
+        first.close()
+        second.close()
+        restarted = LocalRedis(self.path)
+        self.assertEqual((restarted.get("a"), restarted.get("b")), (None, b"2"))
+        self.assertGreater(restarted.pttl("b"), 0)
+
+    def test_compaction(self):
+        writer, reader = LocalRedis(self.path, compact_min_bytes=1000), LocalRedis(self.path)
+        for i in range(200):
+            writer.set("key", str(i))
+        self.assertLess(os.path.getsize(self.path), 1000)
+        self.assertEqual(reader.get("key"), b"199")
+        reader.set("other", "x")
+        self.assertEqual(writer.get("other"), b"x")
+        self.assertEqual(LocalRedis(self.path).data, {b"key": (b"199", 0), b"other": (b"x", 0)})
+
+    def test_forked_process_shares_the_store(self):
+        store = Store(backend="local", path=self.path)
+        self.assertIsNotNone(store.lock("lock:a", 10))
+        pid = os.fork()
+        if pid == 0:
+            code = 0 if store.lock("lock:a", 10) is None else 1
+            store.set("child", "done")
+            os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(store.get("child"), b"done")
+
+    def test_partial_record_is_left_for_later(self):
+        writer, reader = LocalRedis(self.path), LocalRedis(self.path)
+        writer.set("a", "1")
+        record = local_store.RECORD.pack(local_store.SET, 0, 1, 1)
+        with open(self.path, "ab") as f:
+            f.write(record + b"b")
+        self.assertEqual(reader.get("a"), b"1")
+        self.assertIsNone(reader.get("b"))
+        with open(self.path, "ab") as f:
+            f.write(b"2")
+        self.assertEqual(reader.get("b"), b"2")
+
+
+if __name__ == "__main__":
+    unittest.main()
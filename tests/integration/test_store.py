@@ -1,9 +1,17 @@
+import datetime
+import json
+import threading
 import unittest
+from unittest.mock import patch
 
 import fakeredis
 import redis
 
-from store import Store
+import scoring
+import store as store_module
+from scoring import get_interests_bulk, get_score, get_scores, get_score_key, get_legacy_score_key
+from local_store import LocalRedis
+from store import Store, WriteBehind, STORE_DEFAULTS, BACKEND_DEFAULTS, store_config_from_env
 
 
 class StoreConnectedTestCase(unittest.TestCase):
@@ -45,6 +53,305 @@ class StoreConnectedTestCase(unittest.TestCase):
         self.assertEqual(self.store.cache_get(t[0]).decode(), t[1])
 
 
+class StoreInMemoryTestCase(unittest.TestCase):
+    """ Tests run against an in-memory fakeredis storage """
+    def setUp(self):
+        self.store = Store()
+        self.store.client = fakeredis.FakeStrictRedis()
+
+    def test_store_get_many(self):
+        self.store.set("a", "1")
+        self.store.set("c", "3")
+        self.assertEqual(self.store.get_many(["a", "b", "c"]), [b"1", None, b"3"])
+        self.assertEqual(self.store.get_many([]), [])
+
+    @patch.object(store_module, "GET_MANY_CHUNK", 3)
+    def test_store_get_many_is_chunked_in_one_pipeline(self):
+        keys = ["k%s" % i for i in range(10)]
+        for key in keys[::2]:
+            self.store.set(key, key)
+        values = self.store.get_many(keys)
+        self.assertEqual(values, [key.encode() if i % 2 == 0 else None for i, key in enumerate(keys)])
+
+    def test_get_interests_bulk(self):
+        self.store.set("i:1", json.dumps(["sport", "books"]))
+        self.store.set("i:3", json.dumps(["cars"]))
+        self.assertEqual(get_interests_bulk(self.store, [1, 2, 3]), {1: ["sport", "books"], 2: [], 3: ["cars"]})
+
+    def test_cache_get_is_served_locally(self):
+        self.store.cache_set("uid:1", "1.5", 60)
+        # value is gone from Redis, but still alive in the local tier
+        self.store.client.delete("uid:1")
+        self.assertEqual(self.store.cache_get("uid:1"), b"1.5")
+        self.assertEqual(self.store.cache_stats()["hits"], 1)
+
+    def test_cache_get_fills_local_tier_with_redis_ttl(self):
+        self.store.client.setex("uid:2", 60, "3.0")
+        self.assertEqual(self.store.cache_get("uid:2"), b"3.0")
+        self.assertEqual(self.store.cache_stats()["misses"], 1)
+        self.store.client.delete("uid:2")
+        self.assertEqual(self.store.cache_get("uid:2"), b"3.0")
+        self.assertLessEqual(self.store.l1._data["uid:2"][0] - self.store.l1.timer(), 60)
+
+    def test_cache_get_many_and_set_many(self):
+        self.store.client.setex("uid:1", 60, "1.5")
+        self.assertEqual(self.store.cache_set_many({"uid:2": "3.0", "uid:3": 0.5}, 60), True)
+        self.store.l1.delete("uid:3")
+        self.assertEqual(self.store.cache_get_many(["uid:1", "uid:2", "uid:3", "uid:4"]),
+                         [b"1.5", b"3.0", b"0.5", None])
+        self.assertTrue(0 < self.store.client.ttl("uid:3") <= 60)
+
+    def test_get_scores_caches_misses_only(self):
+        cached = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
+        self.store.cache_set(get_score_key(**cached), "10.0", 60)
+        scores = get_scores(self.store, [cached, {"first_name": "a", "last_name": "b"}])
+        self.assertEqual(scores, [10.0, 0.5])
+        self.assertEqual(self.store.client.get(get_score_key(first_name="a", last_name="b")), b"0.5")
+
+    def test_delete_drops_local_copy(self):
+        self.store.cache_set("uid:3", "1.5", 60)
+        self.store.delete("uid:3")
+        self.assertEqual(self.store.cache_get("uid:3"), None)
+
+    def test_absent_keys_are_remembered(self):
+        self.assertEqual(self.store.get_many(["i:1", "i:2"]), [None, None])
+        self.store.client.set("i:1", "[]")
+        # within the ttl the key is still known to be absent, even though somebody else wrote it
+        self.assertEqual(self.store.get("i:1"), None)
+        self.assertEqual(get_interests_bulk(self.store, [1, 2]), {1: [], 2: []})
+        stats = self.store.negative_cache_stats()
+        self.assertEqual((stats["size"], stats["hits"], stats["misses"]), (2, 3, 2))
+
+    def test_absent_keys_are_forgotten_on_write(self):
+        self.assertEqual(self.store.get("i:1"), None)
+        self.assertEqual(self.store.get_many(["i:2", "i:3"]), [None, None])
+        self.store.set("i:1", json.dumps(["cars"]))
+        self.store.set_many({"i:2": json.dumps(["pets"])})
+        self.assertEqual(get_interests_bulk(self.store, [1, 2, 3]), {1: ["cars"], 2: ["pets"], 3: []})
+        self.store.delete("i:3")
+        self.store.client.set("i:3", "[]")
+        self.assertEqual(self.store.get("i:3"), b"[]")
+
+    def test_absent_key_read_racing_with_write_is_not_remembered(self):
+        read = self.store.client.get
+
+        def write_during_read(key):
+            value = read(key)
+            self.store.set(key, "1")
+            return value
+
+        with patch.object(self.store.client, "get", write_during_read):
+            self.assertEqual(self.store.get("i:1"), None)
+        self.assertEqual(self.store.get("i:1"), b"1")
+
+    def test_absent_key_read_during_write_is_not_remembered(self):
+        write = self.store.client.set
+
+        def read_during_write(key, value):
+            # another thread reads Redis after the write has started but before it lands
+            self.assertEqual(self.store.get(key), None)
+            return write(key, value)
+
+        with patch.object(self.store.client, "set", read_during_write):
+            self.store.set("i:1", "1")
+        self.assertEqual(self.store.get("i:1"), b"1")
+
+    def test_absent_keys_read_during_bulk_write_are_not_remembered(self):
+        execute = self.store._execute
+
+        def read_during_write(operation, command, *args):
+            if operation == "set_many":
+                self.assertEqual(self.store.get_many(["i:1", "i:2"]), [None, None])
+            return execute(operation, command, *args)
+
+        with patch.object(self.store, "_execute", read_during_write):
+            self.store.set_many({"i:1": "1", "i:2": "2"})
+        self.assertEqual(self.store.get_many(["i:1", "i:2"]), [b"1", b"2"])
+
+    def test_concurrent_writes_get_distinct_generations(self):
+        def write():
+            for _ in range(1000):
+                self.store._forget_missing([])
+
+        threads = [threading.Thread(target=write) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(next(self.store._generations), 8001)
+
+    def test_default_score_key_secret_is_warned_about(self):
+        with patch.object(scoring, "SCORE_KEY_SECRET", scoring.DEFAULT_SCORE_KEY_SECRET):
+            with self.assertLogs(level="WARNING"):
+                self.assertFalse(scoring.check_score_key_secret())
+        with patch.object(scoring, "SCORE_KEY_SECRET", b"local secret"):
+            self.assertTrue(scoring.check_score_key_secret())
+
+    def test_negative_cache_can_be_turned_off(self):
+        store = Store(negative_cache_size=0)
+        store.client = self.store.client
+        store.get("i:1")
+        self.store.client.set("i:1", "[]")
+        self.assertEqual(store.get("i:1"), b"[]")
+
+    def test_score_key_is_normalized_and_covers_all_fields(self):
+        birthday = datetime.date(2000, 1, 1)
+        key = get_score_key("79175002040", "Stupnikov@otus.ru ", birthday, "1", "A", "b")
+        self.assertTrue(key.startswith("uid:v2:"))
+        self.assertEqual(key, get_score_key(79175002040, "stupnikov@otus.ru", birthday, 1, "a", "B"))
+        self.assertNotEqual(key, get_score_key("79175002040", "stupnikov@otus.ru", birthday, "2", "a", "b"))
+        self.assertNotEqual(key, get_score_key("79175002040", None, birthday, "1", "a", "b"))
+        # fields are delimited: moving characters between them gives another key
+        self.assertNotEqual(get_score_key(first_name="ab", last_name="c"), get_score_key(first_name="a", last_name="bc"))
+
+    def test_legacy_score_keys_are_read(self):
+        self.store.cache_set(get_legacy_score_key("79175002040"), "10.0", 60)
+        self.assertEqual(get_score(self.store, "79175002040", "stupnikov@otus.ru"), 10.0)
+        self.assertEqual(get_scores(self.store, [{"phone": "79175002040", "email": "stupnikov@otus.ru"}]), [10.0])
+        # the legacy value is not copied to the new key
+        self.assertEqual(self.store.client.get(get_score_key("79175002040", "stupnikov@otus.ru")), None)
+        with patch.object(scoring, "LEGACY_KEY_FALLBACK", False):
+            self.assertEqual(get_score(self.store, "79175002040", "stupnikov@otus.ru"), 3.0)
+
+    def test_write_behind_cache(self):
+        store = Store(write_behind=100)
+        store.client = self.store.client
+        self.assertEqual(get_score(store, "79175002040", "stupnikov@otus.ru"), 3.0)
+        key = get_score_key("79175002040", "stupnikov@otus.ru")
+        self.assertEqual(store.cache_get(key), b"3.0")
+        self.assertTrue(store.cache_set_many({"uid:1": "1.5", "uid:2": "0.5"}, 60))
+        store.write_behind.flush()
+        self.assertEqual(self.store.client.get(key), b"3.0")
+        self.assertTrue(0 < self.store.client.ttl("uid:2") <= 60)
+        stats = store.write_behind_stats()
+        self.assertEqual((stats["queued"], stats["flushed"], stats["dropped"]), (3, 3, 0))
+        store.close()
+
+    def test_write_behind_drops_writes_under_pressure(self):
+        release, written = threading.Event(), []
+
+        def slow_write(items):
+            release.wait(5)
+            written.extend(items)
+
+        writer = WriteBehind(slow_write, queue_size=2, batch_size=10)
+        results = [writer.put("uid:%s" % i, "1", 60) for i in range(6)]
+        release.set()
+        writer.flush()
+        stats = writer.stats()
+        self.assertGreaterEqual(stats["dropped"], 3)
+        self.assertEqual(results.count(False), stats["dropped"])
+        self.assertEqual(len(written), stats["flushed"])
+        writer.close()
+
+    def test_concurrent_write_behind_puts_are_all_counted(self):
+        release = threading.Event()
+        writer = WriteBehind(lambda items: release.wait(5), queue_size=100)
+
+        def put():
+            for i in range(1000):
+                writer.put("uid:%s" % i, "1", 60)
+
+        threads = [threading.Thread(target=put) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = writer.stats()
+        self.assertEqual(stats["queued"] + stats["dropped"], 8000)
+        release.set()
+        writer.close()
+
+    def test_write_behind_failures_are_counted(self):
+        def failing_write(items):
+            raise redis.exceptions.ConnectionError("down")
+
+        writer = WriteBehind(failing_write)
+        writer.put("uid:1", "1", 60)
+        writer.flush()
+        self.assertEqual(writer.stats()["failed"], 1)
+        writer.close()
+
+    def test_write_behind_close_does_not_hang_on_a_stuck_write(self):
+        release = threading.Event()
+        writer = WriteBehind(lambda items: release.wait(5))
+        writer.put("uid:1", "1", 60)
+        with self.assertLogs(level="WARNING"):
+            self.assertFalse(writer.close(timeout=0.1))
+        release.set()
+
+    def test_lock_and_unlock(self):
+        token = self.store.lock("lock:uid:1", 5)
+        self.assertTrue(token)
+        self.assertEqual(self.store.lock("lock:uid:1", 5), None)
+        self.assertTrue(0 < self.store.client.pttl("lock:uid:1") <= 5000)
+        self.assertEqual(self.store.unlock("lock:uid:1", "someone else"), False)
+        self.assertEqual(self.store.unlock("lock:uid:1", token), True)
+        self.assertTrue(self.store.lock("lock:uid:1", 5))
+
+    def test_concurrent_score_misses_are_calculated_once(self):
+        calls = []
+
+        def slow_score(*args):
+            calls.append(args)
+            threading.Event().wait(0.05)
+            return 3.0
+
+        with patch.object(scoring, "calculate_score", slow_score):
+            threads = [threading.Thread(target=get_score, args=(self.store, "79175002040", "stupnikov@otus.ru"))
+                       for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(get_score(self.store, "79175002040", "stupnikov@otus.ru"), 3.0)
+
+    def test_store_lock_waits_for_the_holder(self):
+        key = get_score_key("79175002040", "stupnikov@otus.ru")
+        lock = scoring.StoreLock(wait=1.0, poll=0.01)
+        self.assertTrue(self.store.lock("lock:" + key, 5))
+        threading.Timer(0.05, self.store.client.setex, (key, 60, "10.0")).start()
+        with patch.object(scoring, "score_lock", lock), patch.object(scoring, "calculate_score") as calculate:
+            self.assertEqual(get_score(self.store, "79175002040", "stupnikov@otus.ru"), 10.0)
+        calculate.assert_not_called()
+
+    def test_store_lock_is_released_after_calculation(self):
+        key = get_score_key("79175002040", "stupnikov@otus.ru")
+        with patch.object(scoring, "score_lock", scoring.StoreLock()):
+            self.assertEqual(get_score(self.store, "79175002040", "stupnikov@otus.ru"), 3.0)
+        self.assertEqual(self.store.client.get("lock:" + key), None)
+        self.assertEqual(self.store.client.get(key), b"3.0")
+
+
+class StoreConfigTestCase(unittest.TestCase):
+    def test_config_defaults(self):
+        self.assertEqual(store_config_from_env({}), dict(STORE_DEFAULTS, **BACKEND_DEFAULTS))
+
+    def test_config_from_env(self):
+        config = store_config_from_env({"REDIS_HOST": "redis.local", "REDIS_PORT": "6380",
+                                        "REDIS_SOCKET_TIMEOUT": "0.5", "REDIS_KEEPALIVE": "0"})
+        self.assertEqual(config["host"], "redis.local")
+        self.assertEqual(config["port"], 6380)
+        self.assertEqual(config["socket_timeout"], 0.5)
+        self.assertEqual(config["keepalive"], False)
+
+    def test_pool_is_configured(self):
+        store = Store(host="redis.local", port=6380, socket_timeout=0.5, max_connections=7)
+        pool = store.client.connection_pool
+        self.assertEqual(pool.connection_kwargs["host"], "redis.local")
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], 0.5)
+        self.assertEqual(store.pool_stats(), {"max_connections": 7, "created": 0, "idle": 0, "in_use": 0})
+
+    def test_local_backend_is_selected(self):
+        config = store_config_from_env({"STORE_BACKEND": "local", "STORE_PATH": ""})
+        store = Store(**config)
+        self.assertIsInstance(store.client, LocalRedis)
+        self.assertEqual(store.pool_stats(), {})
+        with self.assertRaises(ValueError):
+            Store(backend="memcached")
+
+
 class StoreDisconnectedTestCase(unittest.TestCase):
     """ Tests should pass when our key-value storage (and cache) are not available """
     def setUp(self):
@@ -65,6 +372,21 @@ class StoreDisconnectedTestCase(unittest.TestCase):
         t = ("test_key", "test_value")
         self.assertRaises(redis.exceptions.ConnectionError, self.store.get, t[0])
 
+    def test_store_get_many(self):
+        self.assertRaises(redis.exceptions.ConnectionError, self.store.get_many, ["a", "b"])
+
+    def test_store_fails_fast_when_circuit_is_open(self):
+        for _ in range(self.store.breaker.failure_threshold):
+            self.assertRaises(redis.exceptions.ConnectionError, self.store.get, "test_key")
+        self.assertEqual(self.store.breaker_stats()["state"], "open")
+        rejected = self.store.breaker_stats()["rejected"]
+        self.assertRaises(redis.exceptions.ConnectionError, self.store.get, "test_key")
+        self.assertEqual(self.store.cache_get("test_key"), None)
+        self.assertEqual(self.store.breaker_stats()["rejected"], rejected + 2)
+
+    def test_score_is_calculated_without_cache(self):
+        self.assertEqual(get_score(self.store, "79175002040", "stupnikov@otus.ru"), 3.0)
+
     def test_store_set_cache_value(self):
         t = ("test_key", "test_value")
         self.assertRaises(redis.exceptions.ConnectionError, self.store.cache_set, *t, 60)
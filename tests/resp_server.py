@@ -0,0 +1,62 @@
+import asyncio
+
+import fakeredis
+import redis
+
+
+class RespServer:
+    """ In-process stand-in for a Redis server: speaks RESP on a local port, keeps data in fakeredis """
+
+    def __init__(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "localhost", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = []
+                for _ in range(int(line[1:-2])):
+                    length = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+                writer.write(self.execute(args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def execute(self, args):
+        command = args[0].decode().upper()
+        try:
+            reply = self.redis.execute_command(command, *args[1:])
+        except redis.exceptions.ResponseError as e:
+            return b"-%s\r\n" % str(e).encode()
+        if command == "PING":
+            return b"+PONG\r\n"
+        return self.encode(reply)
+
+    def encode(self, reply):
+        if reply is True:
+            return b"+OK\r\n"
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, (list, tuple)):
+            return b"*%d\r\n" % len(reply) + b"".join(self.encode(item) for item in reply)
+        if isinstance(reply, str):
+            reply = reply.encode()
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
@@ -0,0 +1,46 @@
+import unittest
+
+from admission import AdmissionControl
+
+
+class TestAdmissionControl(unittest.TestCase):
+    def test_in_flight_limit(self):
+        admission = AdmissionControl(2)
+        self.assertTrue(admission.acquire())
+        self.assertTrue(admission.acquire())
+        self.assertFalse(admission.acquire())
+        admission.release()
+        self.assertTrue(admission.acquire())
+        self.assertEqual(admission.stats()["rejected"], 1)
+
+    def test_heavy_requests_leave_room_for_light_ones(self):
+        admission = AdmissionControl(4, reserved=2)
+        self.assertTrue(admission.acquire(10))
+        self.assertTrue(admission.acquire(10))
+        self.assertFalse(admission.acquire(10))
+        self.assertTrue(admission.acquire())
+        self.assertTrue(admission.acquire())
+        self.assertFalse(admission.acquire())
+
+    def test_single_slot_admits_heavy_requests(self):
+        admission = AdmissionControl(1)
+        self.assertTrue(admission.acquire(2))
+        self.assertFalse(admission.acquire())
+        admission.release(2)
+        self.assertTrue(admission.acquire())
+        self.assertEqual(admission.stats()["in_flight"], 1)
+
+    def test_heavy_cost_is_bounded(self):
+        admission = AdmissionControl(10, max_heavy_cost=100)
+        # alone, a request gets in whatever its cost
+        self.assertTrue(admission.acquire(500))
+        self.assertFalse(admission.acquire(1))
+        admission.release(500)
+        self.assertTrue(admission.acquire(60))
+        self.assertFalse(admission.acquire(60))
+        self.assertTrue(admission.acquire(40))
+        self.assertEqual(admission.stats()["heavy_cost"], 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+from cache import TTLCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.cache = TTLCache(maxsize=2, timer=self.timer)
+
+    def test_hit_and_miss(self):
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("b"), None)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_entry_expires(self):
+        self.cache.set("a", 1, ttl=10)
+        self.timer.now = 9.9
+        self.assertEqual(self.cache.get("a"), 1)
+        self.timer.now = 10
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.stats()["expirations"], 1)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertEqual(self.cache.get("b"), None)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("c"), 3)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_delete(self):
+        self.cache.set("a", 1)
+        self.cache.delete("a")
+        self.cache.delete("missing")
+        self.assertEqual(self.cache.get("a"), None)
+
+    def test_disabled_cache(self):
+        cache = TTLCache(maxsize=0)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
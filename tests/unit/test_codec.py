@@ -0,0 +1,42 @@
+import json
+import unittest
+
+import codec
+
+
+class TestCodec(unittest.TestCase):
+    document = {"response": {"1": ["sport", "книги"], "2": []}, "code": 200, "score": 3.5}
+
+    def test_codecs_roundtrip(self):
+        for name in codec.CODECS:
+            c = codec.get_codec(name)
+            data = c.dumps(self.document)
+            self.assertIsInstance(data, bytes, name)
+            self.assertEqual(json.loads(data), self.document, name)
+            self.assertEqual(c.loads(data), self.document, name)
+            self.assertEqual(c.loads(data.decode("utf-8")), self.document, name)
+
+    def test_codecs_agree(self):
+        outputs = {codec.get_codec(name).dumps(self.document) for name in codec.CODECS}
+        self.assertEqual(len(outputs), 1)
+
+    def test_invalid_json(self):
+        for name in codec.CODECS:
+            with self.assertRaises(ValueError):
+                codec.get_codec(name).loads(b"{not json")
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            codec.get_codec("no-such-codec")
+
+    def test_use(self):
+        default = codec.codec
+        try:
+            self.assertEqual(codec.use("json").name, "json")
+            self.assertEqual(codec.dumps([1]), b"[1]")
+        finally:
+            codec.codec = default
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,11 @@
+import datetime
 import unittest
+from unittest.mock import patch
 
+import api
 from tests import cases
 from api import BaseField, ClientIDsField, DateField, BirthDayField, CharField, EmailField, PhoneField, ArgumentsField,\
-                GenderField, ValidationError
+                GenderField, ValidationError, MethodRequest, OnlineScoreRequest, ClientsInterestsRequest
 
 
 class TestBaseField(unittest.TestCase):
@@ -160,5 +163,66 @@ class TestChildFields(unittest.TestCase):
         ArgumentsField().check_conditions(value)
 
 
+class TestDateParsing(unittest.TestCase):
+    def setUp(self):
+        api.parse_date.cache_clear()
+
+    def test_date_is_parsed_once_per_set(self):
+        class Stub:
+            birthday = BirthDayField(required=False, nullable=True)
+
+        inst = Stub()
+        with patch("api.datetime.date", wraps=datetime.date) as date_mock:
+            inst.birthday = "01.01.2000"
+        self.assertEqual(date_mock.call_count, 1)
+        self.assertEqual(inst.birthday, datetime.date(2000, 1, 1))
+
+    def test_parsed_dates_are_memoized(self):
+        BirthDayField().clean("01.01.2000")
+        BirthDayField().clean("01.01.2000")
+        info = api.parse_date.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+    def test_age_limit_cutoff_matches_day_count(self):
+        cutoff = api.age_limit_cutoff()
+        today = datetime.date.today()
+        limit = datetime.timedelta(api.AGE_LIMIT * 365.2425)
+        self.assertFalse(today - cutoff > limit)
+        self.assertTrue(today - (cutoff - datetime.timedelta(days=1)) > limit)
+
+    def test_age_limit_cutoff_is_reused_until_midnight(self):
+        with patch("api._age_limit_cutoff", (api.time.time() + 60, datetime.date(1900, 1, 1))):
+            self.assertEqual(BirthDayField().clean("01.01.1901"), datetime.date(1901, 1, 1))
+        with patch("api._age_limit_cutoff", (0, datetime.date(1900, 1, 1))):
+            with self.assertRaises(ValidationError):
+                BirthDayField().clean("01.01.1901")
+
+
+class TestApiRequest(unittest.TestCase):
+    def test_fields_are_collected_per_class(self):
+        self.assertEqual(MethodRequest.valid_fields, ("account", "login", "token", "arguments", "method"))
+        self.assertEqual(ClientsInterestsRequest.valid_fields, ("client_ids", "date"))
+        self.assertIs(OnlineScoreRequest.phone, OnlineScoreRequest.__dict__["phone"])
+
+    def test_request_has_no_instance_dict(self):
+        request = OnlineScoreRequest(phone=79175002040, email="stupnikov@otus.ru", birthday="01.01.2000")
+        self.assertFalse(hasattr(request, "__dict__"))
+        self.assertEqual(request.phone, "79175002040")
+        self.assertEqual(request.birthday, datetime.date(2000, 1, 1))
+        self.assertEqual(request.first_name, None)
+        self.assertEqual(request.has, ["email", "phone", "birthday"])
+
+    def test_unknown_arguments_are_ignored(self):
+        request = ClientsInterestsRequest(client_ids=[1], login="not a field here")
+        self.assertEqual(request.has, ["client_ids"])
+
+    def test_invalid_field_is_not_logged(self):
+        with patch("api.logging") as logging_mock:
+            with self.assertRaises(ValidationError) as ctx:
+                MethodRequest(login="h&f", token="", arguments={}, method=None)
+        self.assertEqual(ctx.exception.message, "The parameter 'method' is mandatory")
+        logging_mock.exception.assert_not_called()
+
+
 if __name__ == '__main___':
     unittest.main()
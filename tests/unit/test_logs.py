@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import pathlib
+import queue
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import logs
+
+
+class TestBodyPreview(unittest.TestCase):
+    def test_token_is_redacted(self):
+        text = str(logs.BodyPreview({"login": "h&f", "token": "secret", "arguments": {}}))
+        self.assertNotIn("secret", text)
+        self.assertEqual(json.loads(text), {"login": "h&f", "token": "***", "arguments": {}})
+
+    def test_long_body_is_truncated(self):
+        text = str(logs.BodyPreview({"arguments": {"client_ids": list(range(1000))}}, max_length=20))
+        self.assertTrue(text.startswith('{"arguments":{"clien...'))
+        self.assertTrue(text.endswith("chars)"))
+
+    @patch.object(logs, "BODY_SAMPLE_RATE", 3)
+    def test_sampling(self):
+        self.assertEqual(sum(logs.sample_body() for _ in range(30)), 10)
+
+    @patch.object(logs, "BODY_SAMPLE_RATE", 0)
+    def test_sampling_off(self):
+        self.assertFalse(any(logs.sample_body() for _ in range(10)))
+
+
+class TestHandlers(unittest.TestCase):
+    def make_record(self, msg, *args, **fields):
+        record = logging.LogRecord("root", logging.INFO, __file__, 1, msg, args, None)
+        record.fields = fields
+        return record
+
+    def test_json_formatter(self):
+        line = logs.JsonFormatter().format(self.make_record("%s done", "request", code=200, method="online_score"))
+        entry = json.loads(line)
+        self.assertEqual(entry["message"], "request done")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual((entry["code"], entry["method"]), (200, "online_score"))
+
+    def test_text_formatter_appends_fields(self):
+        line = logs.TextFormatter(logs.LOG_FORMAT).format(self.make_record("request", code=200))
+        self.assertTrue(line.endswith("I request code=200"))
+
+    def test_queue_handler_drops_when_full(self):
+        handler = logs.DroppingQueueHandler(queue.Queue(2))
+        for _ in range(5):
+            handler.handle(self.make_record("request"))
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(handler.dropped, 3)
+
+    def test_message_is_formatted_by_the_writer(self):
+        handler = logs.DroppingQueueHandler(queue.Queue())
+        preview = logs.BodyPreview({"token": "x"})
+        with patch.object(logs.BodyPreview, "__str__") as render:
+            handler.handle(self.make_record("%s", preview))
+        render.assert_not_called()
+        self.assertIs(handler.queue.get().args[0], preview)
+
+    def test_setup_logging_writes_json_lines_in_background(self):
+        root = logging.getLogger()
+        handlers, level = root.handlers, root.level
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            logs.setup_logging(filename, json_lines=True)
+            logs.log_request({"request_id": "abc", "code": 200, "response": {"score": 3.0}})
+            logs.stop()
+            with open(filename) as f:
+                entry = json.loads(f.readline())
+        finally:
+            root.handlers, root.level = handlers, level
+            os.remove(filename)
+        self.assertEqual((entry["message"], entry["request_id"], entry["code"]), ("request", "abc", 200))
+        self.assertNotIn("response", entry)
+
+    def test_forked_child_restarts_only_the_current_writer(self):
+        root = logging.getLogger()
+        handlers, level = root.handlers, root.level
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            logs.setup_logging(filename)
+            handler = logs.setup_logging(filename)
+            pid = os.fork()
+            if pid == 0:
+                code = 0 if logs._listener.queue is handler.queue and threading.active_count() == 2 else 1
+                logging.warning("from the child")
+                logs.stop()
+                os._exit(code)
+            _, status = os.waitpid(pid, 0)
+            logs.stop()
+            with open(filename) as f:
+                lines = f.readlines()
+        finally:
+            root.handlers, root.level = handlers, level
+            os.remove(filename)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(sum("from the child" in line for line in lines), 1)
+
+    def test_json_formatter_writes_unknown_fields_as_str(self):
+        record = self.make_record("request", path=pathlib.PurePosixPath("/method"))
+        self.assertEqual(json.loads(logs.JsonFormatter().format(record))["path"], "/method")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from metrics import Registry, Counter, Gauge, Histogram, timed
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = Counter("requests_total", "Requests", ("code",), registry=self.registry)
+        counter.inc(code=200)
+        counter.inc(2, code=200)
+        counter.inc(code=404)
+        self.assertEqual(counter.value(code=200), 3)
+        self.assertEqual(self.registry.render(), "\n".join([
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{code="200"} 3.0',
+            'requests_total{code="404"} 1.0',
+        ]) + "\n")
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("latency_seconds", "Latency", ("method",), buckets=(0.1, 1.0), registry=self.registry)
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, method="online_score")
+        lines = self.registry.render().splitlines()
+        self.assertIn('latency_seconds_bucket{method="online_score",le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{method="online_score",le="1.0"} 3', lines)
+        self.assertIn('latency_seconds_bucket{method="online_score",le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_sum{method="online_score"} 3.65', lines)
+        self.assertIn('latency_seconds_count{method="online_score"} 4', lines)
+
+    def test_histogram_time(self):
+        histogram = Histogram("op_seconds", "Ops", ("operation",), registry=self.registry)
+        with histogram.time(operation="get"):
+            pass
+        self.assertEqual(histogram.count(operation="get"), 1)
+
+    def test_label_values_are_escaped(self):
+        gauge = Gauge("weird", "Weird labels", ("name",), registry=self.registry)
+        gauge.set(1, name='a"b\\c')
+        self.assertIn('weird{name="a\\"b\\\\c"} 1.0', self.registry.render())
+
+    def test_timed(self):
+        ctx = {}
+        with timed(ctx, "auth"):
+            pass
+        self.assertGreaterEqual(ctx["timings"]["auth"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import threading
+import unittest
+
+from retry import RetryPolicy, CircuitBreaker, CircuitOpenError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Flaky:
+    def __init__(self, failures, error=ConnectionError):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error("down")
+        return "ok"
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_policy(self, **kwargs):
+        kwargs.setdefault("jitter", False)
+        return RetryPolicy(sleep=self.clock.sleep, timer=self.clock, retry_on=(ConnectionError,), **kwargs)
+
+    def test_retries_with_exponential_backoff(self):
+        policy = self.make_policy(max_attempts=4, base_delay=0.1, max_delay=1.0, budget=10)
+        self.assertEqual(policy.call(Flaky(3)), "ok")
+        self.assertEqual(self.clock.sleeps, [0.1, 0.2, 0.4])
+
+    def test_backoff_is_capped(self):
+        policy = self.make_policy(max_attempts=5, base_delay=0.5, max_delay=1.0, budget=10)
+        policy.call(Flaky(4))
+        self.assertEqual(self.clock.sleeps, [0.5, 1.0, 1.0, 1.0])
+
+    def test_gives_up_after_max_attempts(self):
+        flaky = Flaky(10)
+        with self.assertRaises(ConnectionError):
+            self.make_policy(max_attempts=3, budget=10).call(flaky)
+        self.assertEqual(flaky.calls, 3)
+
+    def test_gives_up_when_budget_is_spent(self):
+        flaky = Flaky(10)
+        with self.assertRaises(ConnectionError):
+            self.make_policy(max_attempts=10, base_delay=0.3, max_delay=10, budget=1.0).call(flaky)
+        # 0.3 + 0.6 fit into the budget, the next 1.2s delay does not
+        self.assertEqual(self.clock.sleeps, [0.3, 0.6])
+
+    def test_other_errors_are_not_retried(self):
+        flaky = Flaky(1, error=ValueError)
+        with self.assertRaises(ValueError):
+            self.make_policy().call(flaky)
+        self.assertEqual(flaky.calls, 1)
+
+    def test_jitter_stays_within_backoff(self):
+        policy = self.make_policy(base_delay=0.1, max_delay=1.0, jitter=True)
+        for attempt in range(1, 6):
+            self.assertTrue(0 <= policy.backoff(attempt) <= min(1.0, 0.1 * 2 ** (attempt - 1)))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_opens_after_threshold_and_fails_fast(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=5, timer=self.clock)
+        flaky = Flaky(10)
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                breaker.call(flaky)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.call(flaky)
+        self.assertEqual(flaky.calls, 2)
+        self.assertEqual(breaker.stats()["rejected"], 1)
+
+    def test_half_open_trial_closes_circuit(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5, timer=self.clock)
+        with self.assertRaises(ConnectionError):
+            breaker.call(Flaky(1))
+        self.clock.now = 4
+        self.assertFalse(breaker.allow_request())
+        self.clock.now = 5
+        self.assertEqual(breaker.call(lambda: "ok"), "ok")
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, timer=self.clock)
+        with self.assertRaises(ConnectionError):
+            breaker.call(Flaky(1))
+        breaker.call(lambda: "ok")
+        with self.assertRaises(ConnectionError):
+            breaker.call(Flaky(1))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_errors_outside_failure_on_do_not_count(self):
+        breaker = CircuitBreaker(failure_threshold=1, failure_on=(ConnectionError,))
+        with self.assertRaises(ValueError):
+            breaker.call(Flaky(1, error=ValueError))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_background_probe_closes_circuit(self):
+        probed = threading.Event()
+
+        def probe():
+            probed.set()
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01, probe=probe)
+        with self.assertRaises(ConnectionError):
+            breaker.call(Flaky(1))
+        self.assertTrue(probed.wait(1))
+        self.assertTrue(breaker._closed.wait(1))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+if __name__ == '__main__':
+    unittest.main()
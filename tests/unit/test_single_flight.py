@@ -0,0 +1,68 @@
+import threading
+import unittest
+
+from scoring import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def run_concurrently(self, flight, key, fn, n=10):
+        results, errors = [], []
+
+        def call():
+            try:
+                results.append(flight.do(key, fn))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def test_concurrent_callers_share_one_call(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 42
+
+        threads, results, errors = self.run_concurrently(flight, "uid:1", compute)
+        started.wait(5)
+        while flight.stats()["coalesced"] < len(threads) - 1:
+            threading.Event().wait(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [42] * len(threads))
+        self.assertEqual(flight.stats(), {"calls": 1, "coalesced": len(threads) - 1, "in_flight": 0})
+
+    def test_error_is_shared_and_next_call_runs_again(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def fail():
+            release.wait(5)
+            raise ValueError("boom")
+
+        threads, results, errors = self.run_concurrently(flight, "uid:1", fail, n=3)
+        while flight.stats()["coalesced"] < 2:
+            threading.Event().wait(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(flight.do("uid:1", lambda: 1), 1)
+
+    def test_different_keys_do_not_wait_for_each_other(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do("a", lambda: flight.do("b", lambda: 2)), 2)
+        self.assertEqual(flight.stats()["calls"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()